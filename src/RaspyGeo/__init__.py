@@ -1,4 +1,24 @@
-from RaspyGeo.hecgeo import Geometry
-from RaspyGeo.geofun import set_afp, set_lfc
-from RaspyGeo.iterate import run
-from RaspyGeo.parse_geo import parse
+# Top-level exports are imported on first use, so importing RaspyGeo (e.g.
+# in worker processes) does not load HEC-RAS automation or plotting.
+from importlib import import_module
+
+
+exports = {
+    "Geometry": "RaspyGeo.hecgeo",
+    "set_afp": "RaspyGeo.geofun",
+    "set_lfc": "RaspyGeo.geofun",
+    "run": "RaspyGeo.iterate",
+    "parse": "RaspyGeo.parse_geo"
+    }
+
+__all__ = list(exports)
+
+
+def __getattr__(name):
+    if name in exports:
+        return getattr(import_module(exports[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Compact archive of scenario geometries.
+
+Keeping a full copy of the written geometry file for every scenario costs
+the whole file per scenario.  A GeometryArchive is a compressed zip file
+that stores the baseline geometry file once, plus, for each scenario, only
+the cross-section fields that differ from the baseline: coordinates,
+roughness, bank stations, offset, and datum.  Cross-sections that are not
+in the baseline (e.g. interpolated sections) are stored in full.
+
+Each scenario is a separate zip entry, so the zip directory serves as the
+index: any scenario is read without reading the others.  `rebuild` writes
+a scenario's full geometry file through write_geo.read_write, exactly as
+the scenario run wrote it.
+
+Typical use:
+    with GeometryArchive("study.zip", ingeo) as arch:
+        arch.add(scenario, modify(ingeo, modfns))  # or add_file
+    ...
+    with GeometryArchive("study.zip") as arch:
+        arch.rebuild(scenario, "scenario.g01")
+
+Adding a scenario again supersedes the earlier entry (zipfile warns about
+the duplicate name).
+"""
+
+import json
+import os
+import tempfile
+import zipfile
+from copy import deepcopy
+from urllib.parse import quote, unquote
+from RaspyGeo.hecgeo import Geometry, rs2float
+from RaspyGeo.parse_geo import parse
+from RaspyGeo.write_geo import read_write
+
+
+BASELINE = "baseline.g"
+PREFIX = "scenario/"
+
+
+def geo_fields(geo):
+    return {"coordinates": geo.coordinates, "roughness": geo.roughness,
+            "banks": geo.banks, "offset": geo.offset, "datum": geo.datum}
+
+
+def normal(val):
+    # Point lists may hold tuples or lists
+    return [tuple(pt) for pt in val] if isinstance(val, list) else val
+
+
+def xs_delta(old, new):
+    # Fields of Geometry `new` that differ from `old` (all if old is None)
+    new = geo_fields(new)
+    old = {} if old is None else geo_fields(old)
+    return {k: new[k] for k in new
+            if k not in old or normal(new[k]) != normal(old[k])}
+
+
+def reach_delta(old, new):
+    # {rs: xs_delta} for cross-sections of Reach `new` that differ from
+    # Reach `old`
+    deltas = {rs: xs_delta(old.geometries.get(rs), new.geometries[rs])
+              for rs in new.geometries}
+    return {rs: deltas[rs] for rs in deltas if deltas[rs]}
+
+
+def apply_delta(geo, delta):
+    # Set (in place) fields of Geometry geo from an xs_delta
+    if "coordinates" in delta:
+        geo.coordinates = [tuple(pt) for pt in delta["coordinates"]]
+    if "roughness" in delta:
+        geo.roughness = [tuple(pt) for pt in delta["roughness"]]
+    if "banks" in delta:
+        geo.banks = tuple(delta["banks"])
+    for k in ("offset", "datum"):
+        if k in delta:
+            setattr(geo, k, delta[k])
+    return geo
+
+
+class GeometryArchive(object):
+    def __init__(self, path, baseline=None):
+        # path: archive (zip) file.  baseline: the baseline geometry file,
+        # required when creating the archive.  For an existing archive,
+        # the baseline (if given) must be the one it was created with.
+        raw = None
+        if baseline is not None:
+            with open(baseline, "r") as f:
+                raw = f.read()
+        if not os.path.exists(path):
+            if raw is None:
+                raise ValueError("a baseline geometry is needed to create "
+                                 "%s" % path)
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(BASELINE, raw)
+        self.zip = zipfile.ZipFile(path, "a", zipfile.ZIP_DEFLATED)
+        if raw is not None and \
+                self.zip.read(BASELINE).decode("utf-8") != raw:
+            self.zip.close()
+            raise ValueError("%s was created with a different baseline "
+                             "geometry than %s" % (path, baseline))
+        self.tmpdir = None
+        self.reaches = None  # Parsed baseline, when needed
+
+    def __repr__(self):
+        return "GeometryArchive: %d scenarios" % len(self.scenarios())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
+
+    def baseline_file(self):
+        # The baseline geometry, extracted to a temporary file (read_write
+        # and parse work on files)
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            with open(self.baseline_path(), "w") as f:
+                f.write(self.zip.read(BASELINE).decode("utf-8"))
+            self.reaches = parse(self.baseline_path())
+        return self.baseline_path()
+
+    def baseline_path(self):
+        return os.path.join(self.tmpdir.name, BASELINE)
+
+    def scenarios(self):
+        # Scenario names, in the order they were added
+        names = [unquote(nm[len(PREFIX):-len(".json")])
+                 for nm in self.zip.namelist() if nm.startswith(PREFIX)]
+        return list(dict.fromkeys(names))
+
+    def add(self, scenario, reaches):
+        # Archive the geometry of a scenario, {name: Reach} as passed to
+        # read_write (e.g. returned by write_geo.modify)
+        self.baseline_file()
+        delta = {rch: reach_delta(self.reaches[rch], reaches[rch])
+                 for rch in reaches if rch in self.reaches}
+        self.zip.writestr(PREFIX + quote(scenario, safe="") + ".json",
+                          json.dumps({rch: delta[rch] for rch in delta
+                                      if delta[rch]}))
+
+    def add_file(self, scenario, geofile):
+        # Archive a scenario from its written geometry file
+        self.add(scenario, parse(geofile))
+
+    def reaches_for(self, scenario):
+        # Scenario geometry as {name: Reach}
+        self.baseline_file()
+        delta = json.loads(self.zip.read(
+            PREFIX + quote(scenario, safe="") + ".json"))
+        reaches = deepcopy(self.reaches)
+        for rch in delta:
+            geos = reaches[rch].geometries
+            for rs in delta[rch]:
+                if rs not in geos:
+                    geos[rs] = Geometry([(0, 0)], [], (0, 0))
+                apply_delta(geos[rs], delta[rch][rs])
+            reaches[rch].stations = {rs2float(x): x for x in geos}
+            reaches[rch].re_datums()
+        return reaches
+
+    def rebuild(self, scenario, out):
+        # Write the full geometry file of a scenario to `out`
+        read_write(self.baseline_file(), self.reaches_for(scenario), out)
+        return out
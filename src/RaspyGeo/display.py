@@ -7,24 +7,39 @@ Created on Fri Mar 24 09:38:05 2023
 
 """
 Display utilities and testing.
+
+plot_* functions open interactive figures.  For QA of many scenarios,
+render_* functions instead draw many cross-sections or profiles headless
+(Agg), as panels tiled onto sheets, saved to a multi-page PDF or to PNG
+files (rendered in parallel with `workers`).  Dense sections are decimated
+to `maxpts` points for preview, always keeping end points and bank
+stations.
 """
 
-import matplotlib.pyplot as plt
+import os
+from RaspyGeo.hecgeo import elevation
 
 
 cols = 'bgrcmk'
 
 
+def pyplot():
+    # Deferred import, so that importing display (e.g. through testing)
+    # doesn't load matplotlib until something is plotted.
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def plot_xs(xses):
     # Plot up to 6 cross-sections provided as a dictionary
     # of {name: hecgeo.Geometry}.  XSes are plotted on the same axes.
-    fig, ax = plt.subplots()
+    fig, ax = pyplot().subplots()
     for (ix, nm) in enumerate(xses):
         geo = xses[nm].restore()
         x = [i[0] for i in geo["coordinates"]]
         y = [i[1] for i in geo["coordinates"]]
         bst_x = geo["banks"]
-        bst_y = [y[x.index(bx)] if bx in x else 0 for bx in bst_x]
+        bst_y = [elevation(x, y, bx) for bx in bst_x]
         ax.plot(x, y, color=cols[ix % len(cols)], label=nm)
         ax.scatter(bst_x, bst_y, color=cols[ix % len(cols)], label=nm + " Banks")
     ax.set(xlabel='Station', ylabel='Elevation')
@@ -41,7 +56,7 @@ def plot_xspairs(old, new):
 def plot_profiles(reaches):
     # Plot up to 6 reach profiles (datum profiles) provided as a dictionary
     # of {name: hecgeo.Reach}.
-    fig, ax = plt.subplots()
+    fig, ax = pyplot().subplots()
     for (ix, nm) in enumerate(reaches):
         ax.plot(
             reaches[nm].get_sta(),
@@ -51,3 +66,121 @@ def plot_profiles(reaches):
     ax.set(xlabel='River Station', ylabel='Datum Elevation')
     ax.legend()
     fig.show()
+
+
+def decimate(pts, maxpts, keep=()):
+    # Reduce [(x, y)] to about maxpts points by taking every nth point,
+    # always keeping the end points and any stations in `keep`.
+    if len(pts) <= maxpts:
+        return pts
+    step = -(-len(pts) // maxpts)  # ceiling division
+    return [pt for (ix, pt) in enumerate(pts)
+            if ix % step == 0 or ix == len(pts) - 1 or pt[0] in keep]
+
+
+def xs_panel(title, xses, maxpts=200):
+    # Panel of cross-sections {name: Geometry} on the same axes, as
+    # (title, xlabel, ylabel, [(name, points, bank points)])
+    lines = []
+    for nm in xses:
+        geo = xses[nm].restore()
+        pts = geo["coordinates"]
+        x = [i[0] for i in pts]
+        y = [i[1] for i in pts]
+        lines.append((nm, decimate(pts, maxpts, geo["banks"]),
+                      [(bx, elevation(x, y, bx)) for bx in geo["banks"]]))
+    return (title, "Station", "Elevation", lines)
+
+
+def profile_panel(title, reaches):
+    # Panel of datum profiles {name: Reach}, formatted as xs_panel
+    return (title, "River Station", "Datum Elevation",
+            [(nm, list(zip(reaches[nm].get_sta(), reaches[nm].datums)), [])
+             for nm in reaches])
+
+
+def draw_sheet(panels, ncols, nrows):
+    # Panels => headless matplotlib Figure, tiled ncols x nrows
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
+    fig = Figure(figsize=(4 * ncols, 3 * nrows))
+    FigureCanvasAgg(fig)
+    for (ix, (title, xlabel, ylabel, lines)) in enumerate(panels):
+        ax = fig.add_subplot(nrows, ncols, ix + 1)
+        colors = [cols[k % len(cols)] for k in range(len(lines))]
+        ax.add_collection(LineCollection([ln[1] for ln in lines],
+                                         colors=colors, linewidths=1))
+        banks = [(bk, c) for (ln, c) in zip(lines, colors) for bk in ln[2]]
+        if banks:
+            ax.scatter([bk[0][0] for bk in banks], [bk[0][1] for bk in banks],
+                       c=[bk[1] for bk in banks], s=12)
+        ax.autoscale_view()
+        ax.set(title=title, xlabel=xlabel, ylabel=ylabel)
+        ax.legend(handles=[Line2D([], [], color=c, label=ln[0])
+                           for (ln, c) in zip(lines, colors)],
+                  fontsize="small")
+    # Fixed spacing (tight_layout is most of the drawing time), with
+    # margins in inches so labels fit however many panels there are
+    (width, height) = fig.get_size_inches()
+    fig.subplots_adjust(left=0.75 / width, right=1 - 0.25 / width,
+                        bottom=0.5 / height, top=1 - 0.35 / height,
+                        wspace=0.3, hspace=0.5)
+    return fig
+
+
+def save_sheet(panels, ncols, nrows, path, dpi):
+    # Worker: draw and save one PNG sheet
+    draw_sheet(panels, ncols, nrows).savefig(path, dpi=dpi)
+    return path
+
+
+def render(panels, outfile, ncols=3, nrows=2, workers=None, dpi=100):
+    # Panels (xs_panel, profile_panel) => sheets of ncols x nrows.
+    # If outfile ends with .pdf, sheets are pages of one PDF; otherwise it
+    # is a pattern for PNG files with the sheet number, e.g. "qa_%03d.png",
+    # rendered in parallel if workers > 1.
+    # Returns the files written.
+    # A PNG outfile without a pattern gets the sheet number before the
+    # extension, e.g. qa.png => qa_000.png.
+    per = ncols * nrows
+    sheets = [panels[k:(k+per)] for k in range(0, len(panels), per)]
+    if not outfile.lower().endswith(".pdf"):
+        if "%" not in outfile:
+            (root, ext) = os.path.splitext(outfile)
+            outfile = root + "_%03d" + ext
+        try:
+            outfile % 0
+        except (TypeError, ValueError):
+            raise ValueError("%s: PNG outfile must contain one %%d for the "
+                             "sheet number" % outfile)
+    if outfile.lower().endswith(".pdf"):
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(outfile) as pdf:
+            for sheet in sheets:
+                pdf.savefig(draw_sheet(sheet, ncols, nrows))
+        return [outfile]
+    paths = [outfile % k for k in range(len(sheets))]
+    args = (sheets, [ncols] * len(sheets), [nrows] * len(sheets), paths,
+            [dpi] * len(sheets))
+    if workers is not None and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(save_sheet, *args))
+    return list(map(save_sheet, *args))
+
+
+def render_xspairs(old, new, outfile, maxpts=200, **kwargs):
+    # Like plot_xspairs for {rs: Geometry} (e.g. Reach.geometries before and
+    # after a scenario), one panel per station, rendered with `render`.
+    return render([xs_panel(rs, {"Original": old[rs], "New": new[rs]},
+                            maxpts)
+                   for rs in old if rs in new], outfile, **kwargs)
+
+
+def render_profiles(pages, outfile, **kwargs):
+    # Like plot_profiles for [(title, {name: Reach})], one panel each,
+    # rendered with `render`.
+    return render([profile_panel(title, reaches)
+                   for (title, reaches) in pages], outfile, **kwargs)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Distribute scenarios across several machines through a shared job queue.
+
+`run` drives a single local HEC-RAS instance.  To use several (e.g. Windows
+machines with a shared network drive), a coordinator submits scenario specs
+to a queue directory, and each machine runs a worker that claims jobs,
+runs them, and writes back results.  The same queue on a local disk works
+as a stand-in for testing.
+
+Scenario functions can't be serialized, so jobs are specs: a scenario name
+and JSON-compatible parameters.  Every worker has the same builder
+function, which turns parameters into the usual {reach: f(Reach)} scenario
+(e.g. `prepscens` in the README example).  Parameters may be a list
+(builder(*params)) or a dictionary (builder(**params)).
+
+Queue layout (each job is <id>.json, ids in submission order):
+    index.json      {scenario: id}
+    jobs/           pending jobs
+    claimed/        jobs leased by a worker, as <id>.<token>.json with a
+                    token unique to the claim; the lease runs `lease`
+                    seconds from the file's modification time
+    done/           results (<id>.csv, rows formatted as in iterate.cols)
+    failed/         jobs out of retries, or with invalid geometry
+    stop            if present, waiting workers exit
+
+Claiming is an atomic rename from jobs/ to claimed/, so a job has one
+owner at a time.  Whoever moves a claim on (the worker to retry or fail
+it, or the coordinator to requeue an expired one) first renames it to a
+new token, so only one of them can; a worker that has lost its lease
+leaves the job alone.  While a worker runs a job, it renews the lease
+every `lease` / 3 seconds.  If a worker dies, its lease expires and the
+coordinator (reclaim, called by collect) puts the job back in jobs/.
+Results are written atomically and a job with results is never rerun,
+so retries are idempotent.  A worker that hangs keeps renewing its lease,
+so use a supervised evaluate (see supervise.py) to time out hung runs.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from RaspyGeo.iterate import cols
+
+
+STATES = ["jobs", "claimed", "done", "failed"]
+
+
+def write_json(path, data):
+    # Atomic write, so readers never see partial files
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def job_path(queue, state, jid, ext=".json"):
+    return os.path.join(queue, state, jid + ext)
+
+
+def job_ids(queue, state):
+    return sorted(fn[:-5] for fn in os.listdir(os.path.join(queue, state))
+                  if fn.endswith(".json"))
+
+
+def index(queue):
+    # {scenario: id}, in submission order
+    path = os.path.join(queue, "index.json")
+    return read_json(path) if os.path.exists(path) else {}
+
+
+def submit(queue, specs, retries=2, lease=3600):
+    # Coordinator: add scenarios {name: params} to the queue.
+    # Scenarios already in the queue (by name) are not resubmitted.
+    # Returns {scenario: id} for the whole queue.
+    for state in STATES:
+        os.makedirs(os.path.join(queue, state), exist_ok=True)
+    ix = index(queue)
+    for (scen, params) in specs.items():
+        if scen in ix:
+            continue
+        ix[scen] = "%06d" % len(ix)
+        write_json(job_path(queue, "jobs", ix[scen]), {
+            "id": ix[scen], "scenario": scen, "params": params,
+            "attempts": 0, "retries": retries, "lease": lease,
+            "errors": []})
+    write_json(os.path.join(queue, "index.json"), ix)
+    return ix
+
+
+def claim_path(queue, jid, token):
+    return os.path.join(queue, "claimed", "%s.%s.json" % (jid, token))
+
+
+def claims(queue):
+    # [(id, token)] of claimed jobs
+    return sorted(tuple(fn[:-5].split(".")) for fn in
+                  os.listdir(os.path.join(queue, "claimed"))
+                  if fn.endswith(".json"))
+
+
+def take(queue, jid, source):
+    # Move a job file (pending, or claimed) to a new claim owned by the
+    # caller, starting its lease.  Returns the claim path, or None if
+    # someone else got there first.
+    path = claim_path(queue, jid, uuid.uuid4().hex)
+    try:
+        # Touch first: rename keeps the modification time, which must not
+        # look expired even briefly
+        os.utime(source)
+        os.rename(source, path)
+    except OSError:
+        return None
+    return path
+
+
+def requeue(queue, job, path, error):
+    # Return a job taken at `path` to the queue, or fail it if out of
+    # retries.
+    job["attempts"] += 1
+    job["errors"].append(error)
+    job.pop("claim", None)
+    state = "failed" if job["attempts"] > job["retries"] else "jobs"
+    write_json(job_path(queue, state, job["id"]), job)
+    os.remove(path)
+
+
+def retry(queue, job, error):
+    # Worker: return a claimed job to the queue, or fail it if out of
+    # retries.  If the lease was lost, the coordinator already has.
+    path = take(queue, job["id"], job["claim"])
+    if path is not None:
+        requeue(queue, job, path, error)
+
+
+def reclaim(queue):
+    # Coordinator: requeue (or fail) jobs whose lease has expired.
+    for (jid, token) in claims(queue):
+        source = claim_path(queue, jid, token)
+        try:
+            job = read_json(source)
+            expired = time.time() > os.path.getmtime(source) + job["lease"]
+        except (OSError, ValueError):
+            # Finished or retried in the meantime
+            continue
+        if not expired:
+            continue
+        path = take(queue, jid, source)
+        if path is None:
+            continue
+        if os.path.exists(job_path(queue, "done", jid, ".csv")):
+            # Finished just after its lease expired
+            os.remove(path)
+        else:
+            requeue(queue, job, path, "lease expired")
+
+
+def claim(queue):
+    # Worker: take the first pending job, or None if there are none.
+    for jid in job_ids(queue, "jobs"):
+        path = take(queue, jid, job_path(queue, "jobs", jid))
+        if path is None:
+            # Another worker got there first
+            continue
+        job = read_json(path)
+        if os.path.exists(job_path(queue, "done", jid, ".csv")):
+            # Already finished by an earlier attempt
+            os.remove(path)
+            continue
+        job["claim"] = path
+        return job
+    return None
+
+
+def finish(queue, job, rows):
+    # Worker: store results and release the job.
+    path = job_path(queue, "done", job["id"], ".csv")
+    with open(path + ".tmp", "w") as f:
+        f.write("".join(row + "\n" for row in rows))
+    os.replace(path + ".tmp", path)
+    try:
+        os.remove(job["claim"])
+    except FileNotFoundError:
+        # Lease lost; the job is dropped when next claimed
+        pass
+
+
+def fail(queue, job, report):
+    # Worker: fail a claimed job without retrying, unless the lease was
+    # lost.
+    path = take(queue, job["id"], job["claim"])
+    if path is not None:
+        job["errors"].append(report)
+        job.pop("claim")
+        write_json(job_path(queue, "failed", job["id"]), job)
+        os.remove(path)
+
+
+def heartbeat(path, interval, stopped):
+    # Renew a lease every `interval` seconds until `stopped` is set or the
+    # lease is lost
+    while not stopped.wait(interval):
+        try:
+            os.utime(path)
+        except OSError:
+            return
+
+
+def build(builder, params):
+    return builder(**params) if isinstance(params, dict) else \
+        builder(*params)
+
+
+def work(queue, builder, evaluate, poll=None):
+    # Worker loop: claim and run jobs until the queue is empty (poll=None)
+    # or, if waiting for jobs every `poll` seconds, until the stop file
+    # exists.
+    # builder(params) => {reach: f(Reach)} (see module description)
+    # evaluate(scenario, modfns) => (rows, report), e.g. from
+    # iterate.evaluator
+    # Returns the number of jobs run.
+    count = 0
+    while not os.path.exists(os.path.join(queue, "stop")):
+        job = claim(queue)
+        if job is None:
+            if poll is None:
+                break
+            time.sleep(poll)
+            continue
+        stopped = threading.Event()
+        beat = threading.Thread(target=heartbeat, daemon=True,
+                                args=(job["claim"], job["lease"] / 3,
+                                      stopped))
+        beat.start()
+        try:
+            (rows, report) = evaluate(job["scenario"],
+                                      build(builder, job["params"]))
+        except Exception as e:
+            retry(queue, job, repr(e))
+            continue
+        finally:
+            stopped.set()
+            beat.join()
+        count += 1
+        if report:
+            # Invalid geometry won't improve on retry
+            fail(queue, job, report)
+        else:
+            finish(queue, job, rows)
+    return count
+
+
+def collect(queue, outfile, poll=5):
+    # Coordinator: write results to `outfile` (overwritten; same format as
+    # `run`) as they arrive, reclaiming expired leases, until every
+    # submitted scenario is done or failed.
+    # Returns failed jobs, {scenario: job}.
+    ix = index(queue)
+    remaining = list(ix.values())
+    failed = {}
+    with open(outfile, "w") as f:
+        f.write(cols)
+        while True:
+            reclaim(queue)
+            for jid in list(remaining):
+                done = job_path(queue, "done", jid, ".csv")
+                if os.path.exists(done):
+                    with open(done, "r") as r:
+                        f.write(r.read())
+                    f.flush()
+                    remaining.remove(jid)
+                elif os.path.exists(job_path(queue, "failed", jid)):
+                    job = read_json(job_path(queue, "failed", jid))
+                    failed[job["scenario"]] = job
+                    remaining.remove(jid)
+            if not remaining:
+                return failed
+            time.sleep(poll)
+
+
+def stop(queue):
+    # Coordinator: tell waiting workers to exit.
+    open(os.path.join(queue, "stop"), "w").close()
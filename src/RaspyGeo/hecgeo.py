@@ -10,7 +10,10 @@ Define HEC-RAS geometry class(es) as a standardized format.
 """
 
 
+from bisect import bisect_left, bisect_right
+from collections import Counter
 from copy import deepcopy
+from math import ceil
 
 
 def rs2float(rs):
@@ -22,14 +25,157 @@ def rs2float(rs):
         return float(rs)
 
 
+def fmt_rs(rs):
+    # Numeric river station => string with at most two decimals
+    return ("%.2f" % rs).rstrip("0").rstrip(".")
+
+
+def parts(geo):
+    # Split a cross-section at the bank stations into LOB, MC, and ROB.
+    # Returns [(start, width)] in (relative) station for each part.
+    (left, right) = geo.banks
+    end = geo.coordinates[-1][0]
+    return [(0, left), (left, right - left), (right, end - right)]
+
+
+def normalize(geo, x):
+    # Station => (part, position 0-1 within part)
+    pts = parts(geo)
+    part = 0 if x < pts[1][0] else (2 if x > pts[2][0] else 1)
+    (start, width) = pts[part]
+    return (part, (x - start) / width if width > 0 else 0)
+
+
+def elevation(xs, ys, x):
+    # Elevation at station x by linear interpolation (xs ascending)
+    ix = bisect_left(xs, x)
+    if ix == 0:
+        return ys[0]
+    if ix == len(xs):
+        return ys[-1]
+    if xs[ix] == x or xs[ix] == xs[ix-1]:
+        return ys[ix]
+    return ys[ix-1] + (ys[ix] - ys[ix-1]) * (x - xs[ix-1]) / \
+        (xs[ix] - xs[ix-1])
+
+
+def roughness_at(geo, x):
+    # Roughness applying at station x (roughness applies rightwards)
+    rox = [mn[0] for mn in geo.roughness]
+    return geo.roughness[max(bisect_right(rox, x) - 1, 0)][1]
+
+
+def interpolate(down, up, frac):
+    # Geometry between `down` (frac = 0) and `up` (frac = 1).
+    # Like the HEC-RAS default, sections are matched along chords joining
+    # their left edges, bank stations, and right edges: each point of
+    # either section is placed at the same relative position within its
+    # part (LOB, MC, ROB) of the other, and the two are blended linearly.
+    # Roughness breakpoints are matched the same way.
+    def blend(a, b):
+        return (1 - frac) * a + frac * b
+    pd = parts(down)
+    pu = parts(up)
+    pts = [(blend(a[0], b[0]), blend(a[1], b[1])) for (a, b) in zip(pd, pu)]
+
+    def station(part, t):
+        return pts[part][0] + t * pts[part][1]
+
+    def other_x(geo, part, t):
+        (start, width) = parts(geo)[part]
+        return start + t * width
+    geos = [down, up]
+    xys = [([co[0] for co in g.coordinates], [co[1] for co in g.coordinates])
+           for g in geos]
+    # (part, t, elevation in down, elevation in up), from both sections'
+    # points, in order (stable sort keeps vertical walls' point order)
+    merged = sorted([
+        normalize(g, x) + tuple(
+            y if k == j else elevation(xys[k][0], xys[k][1],
+                                       other_x(geos[k], *normalize(g, x)))
+            for k in range(2))
+        for (j, g) in enumerate(geos)
+        for (x, y) in g.coordinates
+        ], key=lambda m: (m[0], m[1]))
+    offset = blend(down.offset, up.offset)
+    datum = blend(down.datum, up.datum)
+
+    def written(x, y=0):
+        # Point as written (to 0.01), so points from both sections that
+        # differ only by float noise are merged
+        return (round(x + offset, 2), round(y + datum, 2))
+    coords = []
+    for (part, t, yd, yu) in merged:
+        pt = (station(part, t), blend(yd, yu))
+        if not coords or written(*pt) != written(*coords[-1]):
+            coords.append(pt)
+    rough = sorted({normalize(g, mn[0]) for g in geos for mn in g.roughness})
+    mann = []
+    for (part, t) in rough:
+        n = blend(roughness_at(down, other_x(down, part, t)),
+                  roughness_at(up, other_x(up, part, t)))
+        x = station(part, t)
+        if mann and written(mann[-1][0]) == written(x):
+            mann[-1] = (x, n)
+        else:
+            mann.append((x, n))
+    return Geometry(
+        [(x + offset, y + datum) for (x, y) in coords],
+        [(x + offset, n) for (x, n) in mann],
+        (pts[1][0] + offset, pts[2][0] + offset))
+
+
+def introduced(old, new):
+    # Stations of points in `new` that a geometry function created, as
+    # opposed to kept from `old`.  Kept points may be shifted vertically
+    # as a whole (e.g. set_afp re-zeroes elevations), so a point counts
+    # as kept if it is at an old station and moved by the common shift.
+    olds = {}
+    for (x, y) in old:
+        olds.setdefault(x, []).append(y)
+    shifts = Counter(round(y - yo, 6)
+                     for (x, y) in new if x in olds
+                     for yo in olds[x])
+    shift = shifts.most_common(1)[0][0] if shifts else 0
+    return {x for (x, y) in new
+            if x not in olds or
+            all(abs(y - shift - yo) > 1e-6 for yo in olds[x])}
+
+
+def dp_keep(coords, first, last, tolerance):
+    # Douglas-Peucker between two kept points, using vertical distance
+    # from the chord.  Returns indices to keep strictly between first and
+    # last.  Iterative, so dense sections cannot hit the recursion limit.
+    keep = []
+    stack = [(first, last)]
+    while stack:
+        (a, b) = stack.pop()
+        if b - a < 2:
+            continue
+        (xa, ya) = coords[a]
+        (xb, yb) = coords[b]
+        # Vertical chords (walls) are never simplified across
+        errs = [abs(coords[i][1] - (ya + (yb - ya) * (coords[i][0] - xa) /
+                                    (xb - xa)))
+                if xb != xa else float("inf")
+                for i in range(a + 1, b)]
+        worst = max(errs)
+        if worst > tolerance:
+            mid = a + 1 + errs.index(worst)
+            keep.append(mid)
+            stack += [(a, mid), (mid, b)]
+    return keep
+
+
 class Geometry(object):
     # For consistency, all coordinates are adjusted so that 0 is the left
     # extreme and 0 is the minimum elevation.  However, datum and offset
     # are stored so real coordinates can be recalculated later.
-    def __init__(self, coord, mann, banksta):
+    def __init__(self, coord, mann, banksta, cutline=None):
         # Coord: X-Y pairs [(sta, elev)]
         # Mann: X-n pairs [(sta, manning)]
         # Banksta: (left, right)
+        # Cutline: GIS cut line as map coordinates [(x, y)], if any
         #
         # Offset: for consistency, left bank = 0; store the offset, though,
         # to recreate later.
@@ -41,6 +187,10 @@ class Geometry(object):
             ]
         self.roughness = [(mn[0] - self.offset, mn[1]) for mn in mann]
         self.banks = (banksta[0] - self.offset, banksta[1] - self.offset)
+        # Stations created by geometry functions (see update); these are
+        # design points and are never removed by simplify.
+        self.fixed = set()
+        self.cutline = [] if cutline is None else cutline
 
     def restore(self):
         # Recreate HEC-RAS-style coordinates (with offset and datum)
@@ -54,10 +204,36 @@ class Geometry(object):
                 (self.banks[0] + self.offset, self.banks[1] + self.offset)
             }
 
+    def content_key(self):
+        # Hashable key for everything that determines the written
+        # cross-section (e.g. for caching).  Geometry functions may return
+        # points as lists, so points are converted to tuples.
+        return (tuple(map(tuple, self.coordinates)),
+                tuple(map(tuple, self.roughness)),
+                tuple(self.banks), self.offset, self.datum)
+
     def update(self, geofun):
         # Update (in place) with a geometry function
+        old = self.coordinates
         (self.coordinates, self.roughness, self.banks) = geofun(
             self.coordinates, self.roughness, self.banks)
+        self.fixed |= introduced(old, self.coordinates)
+        return self
+
+    def simplify(self, tolerance):
+        # Reduce point count (in place) with Douglas-Peucker, dropping
+        # points within `tolerance` (vertical units) of the simplified
+        # line.  End points, bank stations, roughness breakpoints, and
+        # points created by geometry functions are always kept.
+        protect = set(self.banks) | {mn[0] for mn in self.roughness} |\
+            self.fixed
+        co = self.coordinates
+        anchors = [ix for (ix, pt) in enumerate(co)
+                   if ix == 0 or ix == len(co) - 1 or pt[0] in protect]
+        keep = set(anchors)
+        for (a, b) in zip(anchors[:-1], anchors[1:]):
+            keep.update(dp_keep(co, a, b, tolerance))
+        self.coordinates = [pt for (ix, pt) in enumerate(co) if ix in keep]
         return self
 
     def adjusted(self, geofun):
@@ -67,15 +243,20 @@ class Geometry(object):
 
 class Reach(object):
     # Define a Reach class to easily track datums, etc.
-    def __init__(self, name, geometries):
+    def __init__(self, name, geometries, structures=None):
         # Geometries should be a dictionary of {station: geometry}
+        # Structures: (numeric) stations of other blocks in the reach, e.g.
+        # bridges, which sections are not interpolated across
         self.name = name
         self.geometries = geometries  # dictionary
+        self.structures = [] if structures is None else structures
         # Store both numeric value (for sorting, etc) and string value
         # for exact identification (no float errors)
         self.stations = {rs2float(x): x for x in geometries}
         self.upstream = max(self.stations)
         self.downstream = min(self.stations)
+        # Point reduction from the last simplification, {rs: (before, after)}
+        self.reduction = {}
         self.re_datums()  # compute datums
 
     def __repr__(self):
@@ -89,13 +270,16 @@ class Reach(object):
         self.datums = [self.geometries[self.stations[x]].datum
                        for x in sorted(self.stations)]
 
-    def get_sta(self, first=None, last=None):
+    def get_sta(self, first=None, last=None, stations=None):
         # Retrieve ordered, _numerical_ list of stations (i.e. float not str)
+        # If stations (numerical) is given, only those are included, e.g.
+        # stations selected by location with spatial.CutLineIndex.
         first = min(self.stations) if first is None else first
         last = max(self.stations) if last is None else last
         return [sta
                 for sta in sorted(self.stations)
-                if sta >= first and sta <= last]
+                if sta >= first and sta <= last and
+                (stations is None or sta in stations)]
 
     def set_datums(self, delta, first=None, last=None):
         # Update datums by a specified amount
@@ -128,15 +312,64 @@ class Reach(object):
             delta = [down_adj + slope * dist for dist in lengths]
             return deepcopy(self).set_datums(delta, first, last)
 
-    def set_geometry(self, geofun, first=None, last=None):
+    def set_geometry(self, geofun, first=None, last=None, stations=None):
         # Apply a geometry adjustment function to selected cross-sections
         # Modifies in place.
-        to_update = [self.stations[sta] for sta in self.get_sta(first, last)]
+        to_update = [self.stations[sta]
+                     for sta in self.get_sta(first, last, stations)]
         for ud in to_update:
             self.geometries[ud] = self.geometries[ud].update(geofun)
         self.re_datums()
         return self
 
-    def adjust_geometry(self, geofun, first=None, last=None):
+    def adjust_geometry(self, geofun, first=None, last=None, stations=None):
         # Like set_geometry; returns a copy.
-        return deepcopy(self).set_geometry(geofun, first, last)
+        return deepcopy(self).set_geometry(geofun, first, last, stations)
+
+    def set_simplify(self, tolerance, first=None, last=None):
+        # Simplify selected cross-sections (see Geometry.simplify).
+        # Records per-XS point counts in self.reduction.
+        # Modifies in place.
+        to_update = [self.stations[sta] for sta in self.get_sta(first, last)]
+        self.reduction = {}
+        for ud in to_update:
+            before = len(self.geometries[ud].coordinates)
+            self.geometries[ud].simplify(tolerance)
+            self.reduction[ud] = (before,
+                                  len(self.geometries[ud].coordinates))
+        return self
+
+    def simplify(self, tolerance, first=None, last=None):
+        # Like set_simplify; returns a copy.
+        return deepcopy(self).set_simplify(tolerance, first, last)
+
+    def set_interpolated(self, spacing, first=None, last=None):
+        # Add interpolated cross-sections (river stations ending in *)
+        # so that consecutive stations are no more than `spacing` apart.
+        # Run after any geometry modifications, so interpolated sections
+        # follow the modified channel.
+        # Spans containing a structure (e.g. a bridge) are skipped, as are
+        # stations that round (to two decimals) onto existing ones.
+        # Modifies in place.
+        stas = self.get_sta(first, last)
+        taken = set(self.stations)
+        for (dn, up) in zip(stas[:-1], stas[1:]):
+            if any(dn < st < up for st in self.structures):
+                continue
+            count = int(ceil((up - dn) / spacing)) - 1
+            for k in range(1, count + 1):
+                frac = k / (count + 1)
+                rs = fmt_rs(dn + frac * (up - dn))
+                if rs2float(rs) in taken:
+                    continue
+                taken.add(rs2float(rs))
+                self.geometries[rs + "*"] = \
+                    interpolate(self.geometries[self.stations[dn]],
+                                self.geometries[self.stations[up]], frac)
+        self.stations = {rs2float(x): x for x in self.geometries}
+        self.re_datums()
+        return self
+
+    def interpolated(self, spacing, first=None, last=None):
+        # Like set_interpolated; returns a copy.
+        return deepcopy(self).set_interpolated(spacing, first, last)
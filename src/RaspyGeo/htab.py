@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Hydraulic property tables for cross-sections, similar to HEC-RAS HTab.
+
+For each water surface elevation (starting elevation, increment, count),
+tables give area, wetted perimeter, top width, and conveyance for the left
+overbank, main channel, and right overbank, split at the bank stations.
+
+Conveyance K = k/n A R^(2/3) follows the HEC-RAS default method: the
+overbanks are divided at roughness breakpoints and K is summed over the
+roughness regions.  The main channel is divided the same way, unless it
+has more than one n value wetted and a wetted side steeper than 5H:1V, in
+which case K uses a composite n for the whole channel, (sum(P n^1.5) /
+P)^(2/3) over the regions.  k is 1.486 for US customary units and 1 for SI.
+Conveyance is nan for cross-sections without roughness.
+
+Tables are formatted like the scenario data, as [lob, mc, rob] per elevation:
+    {"elevation": [z],
+     "area": [[lob, mc, rob]],
+     "perimeter": [[lob, mc, rob]],
+     "width": [[lob, mc, rob]],
+     "conveyance": [[lob, mc, rob]]}
+
+Computing tables is the expensive part, so TableCache stores them keyed
+by geometry content.  Between scenarios, only modified cross-sections
+are recomputed.
+"""
+
+from bisect import bisect_right
+from math import hypot, nan
+
+
+QUANTITIES = ["area", "perimeter", "width", "conveyance"]
+
+
+def segments(geo):
+    # Geometry => [(x1, y1, x2, y2, subsection, region)], in real
+    # coordinates, with points inserted at bank stations and roughness
+    # breakpoints so each segment has a single subsection (0/1/2 for
+    # LOB/MC/ROB) and roughness region (index into geo.roughness).
+    geos = geo.restore()
+    co = geos["coordinates"]
+    banks = geos["banks"]
+    rox = [mn[0] for mn in geos["roughness"]]
+    breaks = sorted(set(banks) | set(rox))
+    out = []
+    for ((x1, y1), (x2, y2)) in zip(co[:-1], co[1:]):
+        pts = [(x1, y1)] + [
+            (b, y1 + (y2 - y1) * (b - x1) / (x2 - x1))
+            for b in breaks if x1 < b < x2] + [(x2, y2)]
+        for ((xa, ya), (xb, yb)) in zip(pts[:-1], pts[1:]):
+            xm = 0.5 * (xa + xb)
+            sub = 0 if xm < banks[0] else (2 if xm > banks[1] else 1)
+            # Roughness applies from its station rightwards
+            region = max(bisect_right(rox, xm) - 1, 0)
+            out.append((xa, ya, xb, yb, sub, region))
+    return out
+
+
+def wetted(x1, y1, x2, y2, z):
+    # Segment => (area, wetted perimeter, top width) below elevation z
+    d1 = z - y1
+    d2 = z - y2
+    if d1 <= 0 and d2 <= 0:
+        return (0, 0, 0)
+    dx = x2 - x1
+    length = hypot(dx, y2 - y1)
+    if d1 >= 0 and d2 >= 0:
+        return (0.5 * (d1 + d2) * dx, length, dx)
+    # Partially wet: only the fraction below the water surface counts
+    deep = max(d1, d2)
+    frac = deep / (abs(d1) + abs(d2))
+    return (0.5 * deep * frac * dx, frac * length, frac * dx)
+
+
+def property_table(geo, start=None, incr=1.0, count=20, k=1.486):
+    # Geometry => property table (see module description).
+    # start defaults to the lowest point of the section.
+    segs = segments(geo)
+    ns = [mn[1] for mn in geo.roughness]
+    start = min(min(sg[1], sg[3]) for sg in segs) if start is None \
+        else start
+    elevs = [start + incr * ix for ix in range(count)]
+    table = {"elevation": elevs}
+    table.update({q: [] for q in QUANTITIES})
+    for z in elevs:
+        # Accumulate by (subsection, roughness region)
+        acc = {}
+        steep = False  # Any wetted main channel side steeper than 5H:1V
+        for (x1, y1, x2, y2, sub, region) in segs:
+            (a, p, w) = wetted(x1, y1, x2, y2, z)
+            if p > 0:
+                tot = acc.setdefault((sub, region), [0, 0, 0])
+                tot[0] += a
+                tot[1] += p
+                tot[2] += w
+                steep = steep or (sub == 1 and x2 - x1 < 5 * abs(y2 - y1))
+        rows = {q: [0, 0, 0] for q in QUANTITIES}
+        for ((sub, region), (a, p, w)) in acc.items():
+            rows["area"][sub] += a
+            rows["perimeter"][sub] += p
+            rows["width"][sub] += w
+            rows["conveyance"][sub] += k / ns[region] * a * (a / p)**(2/3) \
+                if a > 0 and ns else 0
+        mc = [(ns[region], p) for ((sub, region), (a, p, w)) in acc.items()
+              if sub == 1 and ns]
+        if steep and len(mc) > 1:
+            (a, p) = (rows["area"][1], rows["perimeter"][1])
+            nc = (sum(p_i * n**1.5 for (n, p_i) in mc) / p)**(2/3)
+            rows["conveyance"][1] = k / nc * a * (a / p)**(2/3) \
+                if a > 0 else 0
+        if not ns:
+            rows["conveyance"] = [nan, nan, nan]
+        for q in QUANTITIES:
+            table[q].append(rows[q])
+    return table
+
+
+class TableCache(object):
+    # Property tables keyed by geometry content and table parameters, so
+    # unchanged cross-sections are never recomputed.
+    def __init__(self):
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "TableCache: %d tables, %d hits, %d misses" % (
+            len(self.tables), self.hits, self.misses)
+
+    def table(self, geo, start=None, incr=1.0, count=20, k=1.486):
+        # Geometry => property table (see property_table)
+        key = (geo.content_key(), start, incr, count, k)
+        if key in self.tables:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.tables[key] = property_table(geo, start, incr, count, k)
+        return self.tables[key]
+
+    def reach_tables(self, reach, start=None, incr=1.0, count=20, k=1.486):
+        # Reach => {rs: property table}
+        return {rs: self.table(reach.geometries[rs], start, incr, count, k)
+                for rs in reach.geometries}
+
+    def clear(self):
+        self.tables = {}
@@ -9,9 +9,9 @@ Created on Mon Mar 27 10:07:44 2023
 Iterate through scenarios and retrieve results.
 """
 
-from RaspyGeo.write_geo import read_modify
+from RaspyGeo.write_geo import BlockCache, modify, read_write
+from RaspyGeo.validate import validate
 from RaspyGeo.geofun import set_afp, set_lfc
-from raspy_auto import API, Ras
 
 
 """
@@ -43,6 +43,15 @@ def row_join(row):
     return ",".join([str(r) for r in row])
 
 
+def row_dict(row):
+    # Formatted row => {column: value} according to `cols`.  Location
+    # columns are strings; data columns are floats ("NA" => nan).
+    names = cols.strip().split(",")
+    vals = row.split(",")
+    return {nm: (v if ix < 5 else float("nan") if v == "NA" else float(v))
+            for (ix, (nm, v)) in enumerate(zip(names, vals))}
+
+
 def twovalfix(vals, maxC=False, av=False):
     # Sometimes HEC-RAS will return just two values.  This fixes it to
     # distribute them across the overbanks and MC.
@@ -98,20 +107,126 @@ def scenario_data(ras, nprof, locations, scenario):
         ]
 
 
+def connect(projPath, which="507"):
+    # Start HEC-RAS through Raspy.
+    # Deferred import: raspy_auto loads COM automation, which is slow and
+    # only available where HEC-RAS is installed.
+    from raspy_auto import API, Ras
+    return API(Ras(projPath, which=which))
+
+
+def write_scenario(ingeo, outgeo, modfns, tolerance=None,
+                   skip_invalid=False, cache=None):
+    # Write the geometry for a single scenario.
+    # Returns (validation report, reaches written); if skip_invalid and the
+    # geometry fails validation, nothing is written.
+    # cache: optional write_geo.BlockCache, reused across scenarios
+    reaches = modify(ingeo, modfns, tolerance)
+    if skip_invalid:
+        report = validate(reaches, modfns)
+        if report:
+            return (report, reaches)
+    read_write(ingeo, reaches, outgeo, cache)
+    return ({}, reaches)
+
+
+def run_scenario(ras, projPath, ingeo, outgeo, locations, nprof, scen,
+                 modfns, tolerance=None, skip_invalid=False, cache=None,
+                 archive=None):
+    # Set geometry for a single scenario, run, and retrieve data.
+    # Returns ([formatted row according to `cols`], validation report).
+    # If skip_invalid and the geometry fails validation, the scenario is
+    # not run and there are no rows.
+    # archive: optional archive.GeometryArchive to keep the geometry of
+    # scenarios run in
+    (report, reaches) = write_scenario(ingeo, outgeo, modfns, tolerance,
+                                       skip_invalid, cache)
+    if report:
+        return ([], report)
+    ras.ops.openProject(projPath)
+    ras.ops.compute()
+    rows = scenario_data(ras, nprof, locations, scen)
+    if archive is not None:
+        archive.add(scen, reaches)
+    return (rows, {})
+
+
+def evaluator(projPath, ingeo, outgeo, locations, nprof, which="507",
+              tolerance=None, skip_invalid=False, cache_size=None,
+              archive=None):
+    # Returns f(scenario, modfns) => (rows, report) running scenarios one
+    # at a time (see run_scenario) on a single HEC-RAS instance.
+    # Rendered cross-sections are cached across scenarios, in a
+    # write_geo.BlockCache of cache_size blocks (by default, sized to the
+    # model).
+    ras = connect(projPath, which)
+    cache = BlockCache(cache_size)
+    return lambda scen, modfns: run_scenario(
+        ras, projPath, ingeo, outgeo, locations, nprof, scen, modfns,
+        tolerance, skip_invalid, cache, archive)
+
+
 def run(projPath, ingeo, outgeo, outfile, locations, nprof, scenarios,
-        which="507"):
+        which="507", tolerance=None, skip_invalid=False, store=None,
+        timeout=None, retries=1, kill=None, archive=None, cache_size=None):
     # projPath -> project location
     # locations -> [[identifier, river, reach, rs]] for data retrieval
+    # tolerance -> if given, simplify modified cross-sections to this
+    # vertical tolerance before writing (see Reach.set_simplify)
+    # skip_invalid -> if True, scenarios whose modified geometry fails
+    # validation (see validate.py) are not run
+    # store -> if given, results are also added to this SQLite result
+    # store (see store.py)
+    # timeout -> if given, HEC-RAS runs in a supervised worker process
+    # (see supervise.py): scenarios taking longer than `timeout` seconds
+    # to compute, or crashing, are retried up to `retries` times with a
+    # restarted worker, then skipped.  On restarts, the Ras.exe the
+    # worker started is killed, then kill() is called, if given, for any
+    # other cleanup.  Without a timeout, a hung solver stalls the run.
+    # archive -> if given, the geometry of each scenario run is kept in this
+    # compressed archive (see archive.py), as differences from `ingeo`
+    # cache_size -> number of rendered cross-sections cached across
+    # scenarios (see write_geo.BlockCache); by default, sized to the model
     # Loop through scenarios, set geometry, run simulation, and retrieve data.
     # Scenarios should be a dictionary with labels.  These are used for
     # writing.
     # `outfile` will be overwritten.
-    ras = API(Ras(projPath, which=which))
+    # Returns reports for scenarios that were not run, {scenario: report}:
+    # validation reports, or {"errors": [error]} for scenarios that failed.
+    if archive is not None:
+        # Deferred: archive imports zipfile and json
+        from RaspyGeo.archive import GeometryArchive
+    arch = None if archive is None else GeometryArchive(archive, ingeo)
+    if timeout is None:
+        evaluate = evaluator(projPath, ingeo, outgeo, locations, nprof,
+                             which, tolerance, skip_invalid, cache_size, arch)
+        sup = None
+    else:
+        # Deferred: only needed (with multiprocessing) when supervising
+        from RaspyGeo.supervise import RasBackend, Supervisor, supervised
+        sup = Supervisor(RasBackend(projPath, locations, nprof, which),
+                         timeout, retries, kill)
+        evaluate = supervised(sup, ingeo, outgeo, tolerance, skip_invalid,
+                              cache_size, arch)
+    if store is not None:
+        # Deferred: store imports this module (and sqlite3)
+        from RaspyGeo.store import ResultStore
+    results = None if store is None else ResultStore(store)
+    skipped = {}
     with open(outfile, "w") as f:
         f.write(cols)
         for scen in scenarios:
-            read_modify(ingeo, scenarios[scen], outgeo)
-            ras.ops.openProject(projPath)
-            ras.ops.compute()
-            f.write("\n".join(
-                scenario_data(ras, nprof, locations, scen)) + "\n")
+            (rows, report) = evaluate(scen, scenarios[scen])
+            if report:
+                skipped[scen] = report
+            else:
+                f.write("\n".join(rows) + "\n")
+                if results is not None:
+                    results.add(rows)
+    if results is not None:
+        results.close()
+    if arch is not None:
+        arch.close()
+    if sup is not None:
+        sup.close()
+    return skipped
@@ -59,7 +59,9 @@ To write, it will be necessary to:
 """
 
 
-from RaspyGeo.hecgeo import Geometry, Reach
+import mmap
+import os
+from RaspyGeo.hecgeo import Geometry, Reach, rs2float
 
 
 def mk_name(raw):
@@ -74,6 +76,26 @@ def rest_lines(text):
     return text[(text.find("\n")+1):]
 
 
+def read_fixed(text, width=8):
+    # Fixed-width numeric block => [float], reading fields left to right,
+    # line by line.  HEC-RAS numeric blocks are fixed-width columns (8
+    # characters for Sta/Elev and Mann), so full-width values that run into
+    # their neighbours (e.g. "12345.6712345.67") are still read correctly.
+    # Blank fields (short last lines, trailing padding) are skipped.
+    return [float(ln[k:(k+width)])
+            for ln in text.split("\n")
+            for k in range(0, len(ln), width)
+            if ln[k:(k+width)].strip()]
+
+
+def header_count(text, key):
+    # Number of entries from a block header, e.g. `#Sta/Elev= 15 ` or
+    # `#Mann= 6 ,-1 , 0 ` => 15 or 6.
+    return int(first_line(text[text.find(key):])
+               .split("=")[1]
+               .split(",")[0])
+
+
 def make_geo(text):
     # Cross-section text => Geometry object.
     # Geometry arguments: coordinates [(x, y)], roughness [(x, mann)],
@@ -85,21 +107,28 @@ def make_geo(text):
     # Weirdness: cut off at the _last_ newline
     manntext = manntext[:(len(manntext) - manntext[::-1].find("\n")-1)]
     banktext = first_line(text[text.find("Bank Sta="):]).split("=")[1]
-    # Process station data
-    # Excluding very long chunks: sometimes when one is too long it spills
-    # over; this tends to occur in high-density survey data, so excluding
-    # one point should not be a huge problem.
-    stalist = [x for x in statext.split(" ") if x and len(x) <= 7]
-    sta = [(float(stalist[i]), float(stalist[i+1]))
-           for i in range(0, len(stalist)-1, 2)]
-    # Process Manning's data
-    mannlist = [x for x in manntext.split(" ") if x]
-    mann = [(float(mannlist[i]), float(mannlist[i+1]))
-            for i in range(0, len(mannlist)-2, 3)]
+    # Process station data: pairs of (station, elevation)
+    stalist = read_fixed(statext)[:(2 * header_count(text, "#Sta/Elev="))]
+    sta = list(zip(stalist[0::2], stalist[1::2]))
+    # Process Manning's data: trios of (station, n, 0)
+    mannlist = read_fixed(manntext)[:(3 * header_count(text, "#Mann="))]
+    mann = list(zip(mannlist[0::3], mannlist[1::3]))
     # Proces bank stations
     banklist = banktext.split(",")
     banks = (float(banklist[0]), float(banklist[1]))
-    return Geometry(sta, mann, banks)
+    return Geometry(sta, mann, banks, make_cutline(text))
+
+
+def make_cutline(text):
+    # XS GIS Cut Line => [(x, y)], or [] if there is none.
+    # The header gives the number of points, which follow as 16-character
+    # fixed-width columns, four (two points) to a line.
+    if text.find("XS GIS Cut Line=") < 0:
+        return []
+    npt = header_count(text, "XS GIS Cut Line=")
+    lines = rest_lines(text[text.find("XS GIS Cut Line="):]).split("\n")
+    vals = read_fixed("\n".join(lines[:((npt + 1) // 2)]), 16)[:(2 * npt)]
+    return list(zip(vals[0::2], vals[1::2]))
 
 
 def get_rs(block):
@@ -107,23 +136,85 @@ def get_rs(block):
     return first_line(block).split(",")[1].strip()
 
 
+def is_xs(block):
+    # Exclude XSes missing data (e.g. bridges)
+    return rest_lines(block).find("Bank Sta=") >= 0 \
+        and rest_lines(block).find("#Sta/Elev=") >= 0 \
+        and rest_lines(block).find("#Mann=") >= 0
+
+
 def sep_inner(name, text):
     # Reach-specific text => Reach
     # Reach-specific text is between two pairs of "River Reach=", excluding
     # that particular row.
+    # Other blocks (bridges, culverts, etc) are recorded as structures.
+    blocks = text.split("Type RM Length L Ch R = ")[1:]
     return Reach(name, {
         get_rs(x): make_geo(rest_lines(x))
-        for x in text.split("Type RM Length L Ch R = ")[1:]
-        # Filter: exclude XSes missing data (e.g. bridges)
-        if rest_lines(x).find("Bank Sta=") >= 0
-        and rest_lines(x).find("#Sta/Elev=") >= 0
-        and rest_lines(x).find("#Mann=") >= 0
-        })
-
-
-def parse(file):
+        for x in blocks if is_xs(x)
+        }, [rs2float(get_rs(x)) for x in blocks if not is_xs(x)])
+
+
+def reach_spans(mm):
+    # Byte offsets [(start, end)] of each reach's text (the "River Reach="
+    # marker excluded) in a mapped geometry file, in file order.
+    # Mirrors the string splitting in parse, including the channel
+    # modification cutoff.
+    stop = mm.find(b"CM Alternative")
+    stop = len(mm) if stop < 0 else stop
+    marker = b"River Reach="
+    starts = []
+    ix = mm.find(marker, 0, stop)
+    while ix >= 0:
+        starts.append(ix + len(marker))
+        ix = mm.find(marker, ix + len(marker), stop)
+    # Each reach ends where the next marker begins
+    ends = [st - len(marker) for st in starts[1:]] + [stop]
+    return list(zip(starts, ends))
+
+
+def parse_span(file, start, end):
+    # Worker: build a single Reach from a byte range of the file.
+    # Returns (name, Reach).
+    with open(file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            raw = mm[start:end]
+    # Match text-mode reading (locale encoding, universal newlines)
+    import locale
+    text = raw.decode(locale.getpreferredencoding(False)).replace(
+        "\r\n", "\n").replace("\r", "\n")
+    name = mk_name(first_line(text))
+    return (name, sep_inner(name, rest_lines(text)))
+
+
+def parse_parallel(file, workers):
+    # Build reaches in a process pool.  Workers receive byte offsets into
+    # the file and map it themselves, so no reach text is pickled.
+    # Deferred import: the process pool machinery is slow to load and
+    # only needed here.
+    from concurrent.futures import ProcessPoolExecutor
+    if os.path.getsize(file) == 0:
+        # Empty files can't be mapped (and have no reaches)
+        return {}
+    with open(file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            spans = reach_spans(mm)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map preserves submission order, i.e. file order
+        return dict(pool.map(parse_span,
+                             [file] * len(spans),
+                             [sp[0] for sp in spans],
+                             [sp[1] for sp in spans]))
+
+
+def parse(file, workers=None):
     # Read the file path, then separate it into
     # {reach: fn(name, text)}
+    # If workers is given, reaches are built in parallel by that many
+    # processes (useful for very large geometry files).  The result is
+    # the same either way.
+    if workers is not None and workers > 1:
+        return parse_parallel(file, workers)
     with open(file, "r") as f:
         raw = f.read()
     # Edge cases go here
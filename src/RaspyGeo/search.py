@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive scenario search, to answer questions with fewer HEC-RAS runs.
+
+Grid sweeps (like Width x Datum in the README) are often only run to find
+a threshold or an optimum, e.g. the smallest LFC width at which main
+channel shear drops below a limit.  These drivers choose which scenarios
+to run based on earlier results instead:
+    - bisect: threshold in one parameter, for a monotonic yes/no objective
+    - coordinate_search: local minimum of a numeric objective, one
+    parameter at a time, with shrinking steps
+    - hypercube_search: Latin hypercube samples over all parameters, then
+    repeated sampling in a shrinking box around the best so far
+
+All of them work through Evaluations, which builds each scenario from a
+parameter list (builder(*params) => {reach: f(Reach)}, as for `run`),
+runs it, and writes every evaluated scenario to the output file in the
+usual format.  Objectives receive the scenario's rows as dictionaries (see
+iterate.row_dict); e.g. for the shear example,
+    lambda rows: column_max(rows, "shear.mc") < limit
+
+Scenarios that fail validation (with skip_invalid) have no rows, and their
+objective is treated as False (bisect) or infinite (minimization).
+"""
+
+import random
+from RaspyGeo.iterate import cols, row_dict
+
+
+class Evaluations(object):
+    # Run scenarios by parameters, writing results to `outfile`
+    # (overwritten) and remembering them, so no scenario is run twice.
+    # evaluate(scenario, modfns) => (rows, report), e.g. from
+    # iterate.evaluator
+    def __init__(self, evaluate, builder, outfile):
+        self.evaluate = evaluate
+        self.builder = builder
+        self.outfile = outfile
+        self.results = {}  # {params: [row dict]}, None if invalid
+        with open(outfile, "w") as f:
+            f.write(cols)
+
+    def __repr__(self):
+        return "Evaluations: %d scenarios run" % len(self.results)
+
+    def __call__(self, params):
+        params = tuple(params)
+        if params not in self.results:
+            # No commas in scenario names; repr, so that distinct
+            # parameters always give distinct names
+            scen = "Search " + " ".join(repr(p) for p in params)
+            (rows, report) = self.evaluate(scen, self.builder(*params))
+            if report:
+                self.results[params] = None
+            else:
+                with open(self.outfile, "a") as f:
+                    f.write("\n".join(rows) + "\n")
+                self.results[params] = [row_dict(row) for row in rows]
+        return self.results[params]
+
+
+def column_max(rows, column, ident=None):
+    # Maximum of a column over rows, optionally for one location ID
+    return max(row[column] for row in rows
+               if ident is None or row["ID"] == ident)
+
+
+def at(point, ix, val):
+    return point[:ix] + [val] + point[(ix+1):]
+
+
+def score(evals, objective, params):
+    rows = evals(params)
+    return float("inf") if rows is None else objective(rows)
+
+
+def bisect(evals, objective, lo, hi, point=None, ix=0, tol=0.1):
+    # Smallest value of parameter `ix` in [lo, hi] for which objective
+    # (rows => bool) is True, assuming it is False below some threshold
+    # and True above.  Other parameters are taken from `point`.
+    # Returns the value to within tol, or None if the objective is False
+    # even at hi.
+    point = [lo] if point is None else list(point)
+
+    def test(val):
+        rows = evals(at(point, ix, val))
+        return rows is not None and objective(rows)
+    if not test(hi):
+        return None
+    if test(lo):
+        return lo
+    while hi - lo > tol:
+        mid = 0.5 * (lo + hi)
+        if test(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def coordinate_search(evals, objective, bounds, start=None, step=None,
+                      tol=0.1, maxeval=100):
+    # Minimize objective (rows => float) over parameters within bounds
+    # [(lo, hi)], trying a step up and down in each parameter in turn and
+    # halving steps when nothing improves.  Starts from the middle of the
+    # bounds with steps of a quarter of their width unless specified.
+    # Returns (best parameters, best objective).
+    best = [0.5 * (lo + hi) for (lo, hi) in bounds] if start is None \
+        else list(start)
+    steps = [0.25 * (hi - lo) for (lo, hi) in bounds] if step is None \
+        else list(step)
+    fbest = score(evals, objective, best)
+    while max(steps) > tol and len(evals.results) < maxeval:
+        improved = False
+        for (ix, (lo, hi)) in enumerate(bounds):
+            for val in [best[ix] - steps[ix], best[ix] + steps[ix]]:
+                val = min(max(val, lo), hi)
+                fval = score(evals, objective, at(best, ix, val))
+                if fval < fbest:
+                    (best, fbest, improved) = (at(best, ix, val), fval, True)
+                    break
+        if not improved:
+            steps = [st / 2 for st in steps]
+    return (best, fbest)
+
+
+def latin_hypercube(bounds, n, rng=random):
+    # n points within bounds [(lo, hi)], one in each of n equal slices of
+    # every parameter's range
+    samples = []
+    for (lo, hi) in bounds:
+        slices = list(range(n))
+        rng.shuffle(slices)
+        samples.append([lo + (hi - lo) * (sl + rng.random()) / n
+                     for sl in slices])
+    return [list(pt) for pt in zip(*samples)]
+
+
+def hypercube_search(evals, objective, bounds, n=10, rounds=3, shrink=0.5,
+                     seed=None):
+    # Minimize objective (rows => float): sample n points by Latin
+    # hypercube, then for each further round, shrink the box by `shrink`
+    # around the best point so far and sample again.
+    # Returns (best parameters, best objective).
+    rng = random.Random(seed)
+    (best, fbest) = (None, float("inf"))
+    for _ in range(rounds):
+        for pt in latin_hypercube(bounds, n, rng):
+            fval = score(evals, objective, pt)
+            if fval < fbest:
+                (best, fbest) = (pt, fval)
+        if best is None:
+            # Nothing valid yet; sample the same box again
+            continue
+        bounds = [(max(lo, b - shrink * (hi - lo) / 2),
+                   min(hi, b + shrink * (hi - lo) / 2))
+                  for ((lo, hi), b) in zip(bounds, best)]
+    return (best, fbest)
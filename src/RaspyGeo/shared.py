@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Share a parsed baseline geometry between scenario worker processes.
+
+Without this, each worker has to re-parse the baseline geometry or receive
+a pickled copy of every Reach and Geometry.  Instead, the parent publishes
+the baseline once: all coordinate and roughness values go into a single
+shared memory segment of doubles, and a small manifest (reach names,
+stations, offsets, datums, bank stations, cut lines, and positions in the
+segment) is passed to workers.
+
+Workers attach to the segment and get Reaches of SharedGeometry objects,
+which read from a read-only view.  A cross-section's coordinates and
+roughness are only copied out when they are accessed for modification
+(e.g. by Geometry.update), so each scenario copies just the XSes it
+changes.  Datum changes and writing (restore) read the view directly.
+
+Typical use:
+    with publish(parse(ingeo)) as base:
+        with ProcessPoolExecutor(initializer=init_worker,
+                                 initargs=(base.manifest,)) as pool:
+            ...
+and in the worker, worker_reaches() returns a fresh set of baseline
+Reaches for each scenario.
+"""
+
+from array import array
+from copy import deepcopy
+from multiprocessing import shared_memory
+from RaspyGeo.hecgeo import Geometry, Reach
+
+
+def flat(pairs):
+    return [i for x in pairs for i in x]
+
+
+def unflat(vals):
+    return list(zip(vals[0::2], vals[1::2]))
+
+
+def plain_geometry(state):
+    # Unpickle a SharedGeometry as a plain Geometry
+    geo = Geometry.__new__(Geometry)
+    geo.__dict__.update(state)
+    return geo
+
+
+class SharedGeometry(Geometry):
+    # Geometry backed by a read-only view into a shared baseline.
+    def __init__(self, view, entry):
+        # entry: (rs, start, coordinate count, roughness count, offset,
+        # datum, banks, cut line), as in the manifest
+        (_, self.start, self.ncoord, self.nrough,
+         self.offset, self.datum, banks, cutline) = entry
+        self.banks = tuple(banks)
+        self.cutline = cutline
+        self.fixed = set()
+        self.view = view
+        self._coordinates = None
+        self._roughness = None
+
+    def read_coordinates(self):
+        return unflat(self.view[
+            self.start:(self.start + 2*self.ncoord)].tolist())
+
+    def read_roughness(self):
+        rstart = self.start + 2*self.ncoord
+        return unflat(self.view[rstart:(rstart + 2*self.nrough)].tolist())
+
+    # Coordinates and roughness are copied out of the view on first access
+    @property
+    def coordinates(self):
+        if self._coordinates is None:
+            self._coordinates = self.read_coordinates()
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self, value):
+        self._coordinates = value
+
+    @property
+    def roughness(self):
+        if self._roughness is None:
+            self._roughness = self.read_roughness()
+        return self._roughness
+
+    @roughness.setter
+    def roughness(self, value):
+        self._roughness = value
+
+    def restore(self):
+        # As Geometry.restore, but without keeping copies of untouched
+        # cross-sections.
+        co = self._coordinates if self._coordinates is not None else \
+            self.read_coordinates()
+        ro = self._roughness if self._roughness is not None else \
+            self.read_roughness()
+        return {
+            "coordinates":
+                [(c[0] + self.offset, c[1] + self.datum) for c in co],
+            "roughness":
+                [(mn[0] + self.offset, mn[1]) for mn in ro],
+            "banks":
+                (self.banks[0] + self.offset, self.banks[1] + self.offset)
+            }
+
+    def content_key(self):
+        # Untouched cross-sections are identified by their place in the
+        # shared baseline, without copying them out
+        if self.copied():
+            return Geometry.content_key(self)
+        return ("shared", self.start, self.ncoord, self.nrough, self.offset,
+                self.datum, self.banks)
+
+    def copied(self):
+        # Whether this cross-section has been copied out of the view
+        return self._coordinates is not None or self._roughness is not None
+
+    def materialize(self):
+        # Plain Geometry copy, independent of shared memory
+        geo = Geometry.__new__(Geometry)
+        geo.offset = self.offset
+        geo.datum = self.datum
+        geo.coordinates = deepcopy(self.coordinates)
+        geo.roughness = deepcopy(self.roughness)
+        geo.banks = self.banks
+        geo.fixed = set(self.fixed)
+        geo.cutline = list(self.cutline)
+        return geo
+
+    def __deepcopy__(self, memo):
+        # The view is read-only, so copies share it; only data already
+        # copied out is duplicated.  (copy() would go through pickling.)
+        new = SharedGeometry.__new__(SharedGeometry)
+        new.__dict__.update(self.__dict__)
+        new._coordinates = deepcopy(self._coordinates, memo)
+        new._roughness = deepcopy(self._roughness, memo)
+        new.fixed = set(self.fixed)
+        return new
+
+    def __reduce_ex__(self, protocol):
+        # Views can't be pickled; send a plain Geometry instead.
+        return (plain_geometry, (self.materialize().__dict__,))
+
+
+class SharedBaseline(object):
+    # Owner of a published baseline.  Pass `manifest` to workers; close
+    # (or use as a context manager) to free the shared memory.
+    def __init__(self, shm, manifest):
+        self.shm = shm
+        self.manifest = manifest
+
+    def __repr__(self):
+        return "SharedBaseline %s: %d reaches, %d values" % (
+            self.manifest["name"], len(self.manifest["reaches"]),
+            self.manifest["size"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def publish(reaches):
+    # {name: Reach} (e.g. from parse) => SharedBaseline
+    values = array("d")
+    manifest = []
+    for nm in reaches:
+        entries = []
+        for (rs, geo) in reaches[nm].geometries.items():
+            entries.append((rs, len(values), len(geo.coordinates),
+                            len(geo.roughness), geo.offset, geo.datum,
+                            tuple(geo.banks), geo.cutline))
+            values.extend(flat(geo.coordinates))
+            values.extend(flat(geo.roughness))
+        manifest.append((nm, entries, reaches[nm].structures))
+    nbytes = len(values) * values.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    shm.buf[:nbytes] = memoryview(values).cast("B")
+    return SharedBaseline(shm, {"name": shm.name, "size": len(values),
+                                "reaches": manifest})
+
+
+class BaselineView(object):
+    # Worker-side attachment to a published baseline.
+    def __init__(self, manifest):
+        try:
+            # Python 3.13+: the owner manages the segment's lifetime
+            self.shm = shared_memory.SharedMemory(name=manifest["name"],
+                                                  track=False)
+        except TypeError:
+            self.shm = shared_memory.SharedMemory(name=manifest["name"])
+        self.manifest = manifest
+        self.view = self.shm.buf.cast("d")[:manifest["size"]].toreadonly()
+
+    def reaches(self):
+        # Fresh baseline {name: Reach}, sharing the underlying data.
+        return {nm: Reach(nm, {entry[0]: SharedGeometry(self.view, entry)
+                               for entry in entries}, structures)
+                for (nm, entries, structures) in self.manifest["reaches"]}
+
+    def close(self):
+        # Reaches from this view are unusable afterwards.
+        self.view.release()
+        self.shm.close()
+
+
+attached = None
+
+
+def init_worker(manifest):
+    # Process pool initializer: attach to the baseline once per worker.
+    global attached
+    attached = BaselineView(manifest)
+
+
+def worker_reaches():
+    # Baseline {name: Reach} in a worker set up with init_worker
+    return attached.reaches()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Select cross-sections by location, using their GIS cut lines.
+
+Scenario functions normally select cross-sections by river station range
+(first/last).  CutLineIndex instead finds those whose cut lines fall in a
+polygon or within a distance of a point, in map coordinates, across any
+number of reaches.  Cut lines are indexed by bounding box in a uniform
+grid, so a query only checks cut lines in nearby cells.
+
+Queries return {reach name: [river station]} (numerical stations), which
+can be passed to Reach.set_geometry/adjust_geometry as `stations`, e.g.:
+    index = CutLineIndex(parse(ingeo))
+    site = index.near((6536300, 1829600), 500)
+    modfns = {nm: lambda rch, st=site[nm]: rch.adjust_geometry(
+        set_lfc(10, 1, 4, 0.035, 0.1), stations=st) for nm in site}
+
+Cross-sections without cut lines (e.g. interpolated sections) are never
+selected.
+"""
+
+from math import floor, hypot, sqrt
+from RaspyGeo.hecgeo import rs2float
+
+
+def bbox(pts):
+    xs = [p[0] for p in pts]
+    ys = [p[1] for p in pts]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def orient(a, b, c):
+    # Sign of the turn a => b => c
+    v = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (v > 0) - (v < 0)
+
+
+def on_segment(a, b, c):
+    # c (collinear with a-b) lies on segment a-b
+    return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and \
+        min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+
+def crosses(a, b, c, d):
+    # Segments a-b and c-d intersect
+    (o1, o2, o3, o4) = (orient(a, b, c), orient(a, b, d),
+                        orient(c, d, a), orient(c, d, b))
+    if o1 != o2 and o3 != o4:
+        return True
+    return (o1 == 0 and on_segment(a, b, c)) or \
+        (o2 == 0 and on_segment(a, b, d)) or \
+        (o3 == 0 and on_segment(c, d, a)) or \
+        (o4 == 0 and on_segment(c, d, b))
+
+
+def inside(polygon, pt):
+    # Point in polygon [(x, y)] (ray casting)
+    res = False
+    for (a, b) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (a[1] > pt[1]) != (b[1] > pt[1]) and \
+                pt[0] < a[0] + (pt[1] - a[1]) * (b[0] - a[0]) / (b[1] - a[1]):
+            res = not res
+    return res
+
+
+def seg_distance(a, b, pt):
+    # Distance from pt to segment a-b
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    ln2 = dx * dx + dy * dy
+    t = 0 if ln2 == 0 else max(0, min(1, (
+        (pt[0] - a[0]) * dx + (pt[1] - a[1]) * dy) / ln2))
+    return hypot(a[0] + t * dx - pt[0], a[1] + t * dy - pt[1])
+
+
+def segs(pts):
+    return list(zip(pts[:-1], pts[1:])) if len(pts) > 1 else \
+        [(pts[0], pts[0])]
+
+
+class CutLineIndex(object):
+    # Grid index of cross-section cut lines over {name: Reach}.
+    # cell: grid cell size in map units; by default, the larger dimension
+    # of the area covered is split into sqrt(number of cut lines) cells,
+    # which stays sensible when cut lines are all in a line.
+    def __init__(self, reaches, cell=None):
+        # [(reach name, rs, cut line, bounding box)]
+        self.lines = [(nm, rs, geo.cutline, bbox(geo.cutline))
+                      for nm in reaches
+                      for (rs, geo) in reaches[nm].geometries.items()
+                      if geo.cutline]
+        ext = bbox([pt for ln in self.lines
+                    for pt in [ln[3][:2], ln[3][2:]]]) if self.lines \
+            else None
+        if ext is not None and cell is None:
+            span = max(ext[2] - ext[0], ext[3] - ext[1])
+            cell = span / sqrt(len(self.lines)) if span > 0 else None
+        self.cell = 1 if cell is None else cell
+        # Grid cells covered, so queries never visit cells beyond the data
+        self.extent = None if ext is None else self.cell_range(ext)
+        self.grid = {}
+        for (ix, ln) in enumerate(self.lines):
+            for key in self.cells(ln[3]):
+                self.grid.setdefault(key, []).append(ix)
+
+    def __repr__(self):
+        return "CutLineIndex: %d cut lines in %d cells of %g units" % (
+            len(self.lines), len(self.grid), self.cell)
+
+    def cell_range(self, box):
+        # Bounding box => (i0, j0, i1, j1) of the grid cells it overlaps
+        return tuple(floor(v / self.cell) for v in box)
+
+    def cells(self, box):
+        # Indexed grid cells overlapping a bounding box
+        if self.extent is None:
+            return []
+        (i0, j0, i1, j1) = self.cell_range(box)
+        (e0, f0, e1, f1) = self.extent
+        return [(i, j) for i in range(max(i0, e0), min(i1, e1) + 1)
+                for j in range(max(j0, f0), min(j1, f1) + 1)]
+
+    def candidates(self, box):
+        # Cut lines whose bounding boxes overlap `box`
+        found = {ix for key in self.cells(box)
+                 for ix in self.grid.get(key, [])}
+        return [ix for ix in sorted(found)
+                if self.lines[ix][3][0] <= box[2] and
+                self.lines[ix][3][2] >= box[0] and
+                self.lines[ix][3][1] <= box[3] and
+                self.lines[ix][3][3] >= box[1]]
+
+    def result(self, found):
+        # [line index] => {reach name: [river station]}
+        out = {}
+        for ix in found:
+            out.setdefault(self.lines[ix][0], []).append(
+                rs2float(self.lines[ix][1]))
+        return {nm: sorted(out[nm]) for nm in out}
+
+    def within(self, polygon):
+        # Cross-sections whose cut lines touch polygon [(x, y)]
+        poly_segs = segs(polygon + polygon[:1])
+        return self.result([
+            ix for ix in self.candidates(bbox(polygon))
+            if any(inside(polygon, pt) for pt in self.lines[ix][2]) or
+            any(crosses(a, b, c, d)
+                for (a, b) in segs(self.lines[ix][2])
+                for (c, d) in poly_segs)])
+
+    def near(self, point, radius):
+        # Cross-sections whose cut lines pass within radius of point (x, y)
+        box = (point[0] - radius, point[1] - radius,
+               point[0] + radius, point[1] + radius)
+        return self.result([
+            ix for ix in self.candidates(box)
+            if min(seg_distance(a, b, point)
+                   for (a, b) in segs(self.lines[ix][2])) <= radius])
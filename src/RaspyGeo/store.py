@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed result store (SQLite) with baseline comparisons.
+
+The scenario data file written by `run` has to be read in full to answer
+questions like "change in MC shear vs baseline at location X across all
+scenarios".  A ResultStore keeps the same data in a SQLite database,
+indexed by scenario and by location ID and profile, and computes
+differences from a baseline scenario in the database.
+
+Columns follow iterate.cols, with dots replaced by underscores (shear.mc =>
+shear_mc), plus `profile`, the profile number in the order `run` writes
+them for each scenario and location.  Queries accept either column
+spelling.  "NA" values are stored as NULL and returned as nan.
+
+Query results are {"scenario": [str], "id": [str], "profile": [int],
+"delta": array of doubles}, in the order the rows were added.
+"""
+
+import sqlite3
+from array import array
+from RaspyGeo.iterate import cols
+
+
+NAMES = cols.strip().split(",")
+COLUMNS = [nm.lower().replace(".", "_") for nm in NAMES[:5]] + \
+    ["profile"] + [nm.replace(".", "_") for nm in NAMES[5:]]
+QUANTITIES = COLUMNS[6:]
+
+
+def column(name):
+    # Column name, validated (it is inserted into SQL)
+    name = name.replace(".", "_")
+    if name not in QUANTITIES:
+        raise ValueError("unknown quantity %s" % name)
+    return name
+
+
+class ResultStore(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (%s)" % ", ".join(
+            ["%s TEXT" % c for c in COLUMNS[:5]] + ["profile INTEGER"] +
+            ["%s REAL" % c for c in QUANTITIES]))
+        self.db.execute("CREATE INDEX IF NOT EXISTS by_scenario "
+                        "ON results (scenario)")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS by_location "
+                        "ON results (id, profile, scenario)")
+        self.db.commit()
+
+    def __repr__(self):
+        return "ResultStore: %d scenarios, %d rows" % (
+            len(self.scenarios()),
+            self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0])
+
+    def close(self):
+        self.db.close()
+
+    def scenarios(self):
+        return [r[0] for r in self.db.execute(
+            "SELECT DISTINCT scenario FROM results ORDER BY rowid")]
+
+    def add(self, rows):
+        # Add formatted rows (see iterate.cols).  Scenarios in `rows`
+        # replace any stored rows for the same scenarios.
+        recs = []
+        profiles = {}
+        for row in rows:
+            vals = row.split(",")
+            loc = (vals[0], vals[1])
+            profiles[loc] = profiles.get(loc, -1) + 1
+            recs.append(vals[:5] + [profiles[loc]] + [
+                None if v == "NA" else float(v) for v in vals[5:]])
+        self.db.executemany("DELETE FROM results WHERE scenario = ?",
+                            [(sc,) for sc in {loc[0] for loc in profiles}])
+        self.db.executemany("INSERT INTO results VALUES (%s)" % ",".join(
+            "?" * len(COLUMNS)), recs)
+        self.db.commit()
+
+    def import_file(self, path):
+        # Add a scenario data file, as written by `run`
+        with open(path, "r") as f:
+            self.add([ln.strip() for ln in f.readlines()[1:] if ln.strip()])
+
+    def query(self, select, args, ident, profile, key):
+        # Run a query selecting (scenario, id, profile, value), with
+        # optional ID and profile filters, in insertion order
+        if ident is not None:
+            select += " AND s.id = ?"
+            args.append(ident)
+        if profile is not None:
+            select += " AND s.profile = ?"
+            args.append(profile)
+        res = self.db.execute(select + " ORDER BY s.rowid", args).fetchall()
+        return {"scenario": [r[0] for r in res],
+                "id": [r[1] for r in res],
+                "profile": [r[2] for r in res],
+                key: array("d", [float(r[3]) for r in res])}
+
+    def delta(self, quantity, baseline, ident=None, profile=None):
+        # Scenario value minus baseline value of `quantity` for every other
+        # scenario, at matching location ID and profile, optionally for
+        # one ID and/or profile.
+        return self.query(
+            "SELECT s.scenario, s.id, s.profile, "
+            "COALESCE(s.{0} - b.{0}, 'nan') FROM results s "
+            "JOIN results b ON b.scenario = ? AND b.id = s.id "
+            "AND b.profile = s.profile "
+            "WHERE s.scenario != ?".format(column(quantity)),
+            [baseline, baseline], ident, profile, "delta")
+
+    def values(self, quantity, ident=None, profile=None):
+        # Stored values of `quantity`, formatted like delta but with
+        # "value" in place of "delta"
+        return self.query(
+            "SELECT s.scenario, s.id, s.profile, COALESCE(s.{0}, 'nan') "
+            "FROM results s WHERE 1".format(column(quantity)),
+            [], ident, profile, "value")
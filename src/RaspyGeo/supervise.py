@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Supervised HEC-RAS execution: timeouts, restarts, retries, and quarantine.
+
+Run in-process, a hung compute stalls a sweep indefinitely, and a crash or
+exception ends it.  A Supervisor instead runs the backend (HEC-RAS through
+Raspy) in a worker process and sends it one scenario at a time.  If a
+scenario takes longer than `timeout` seconds, the worker crashes, or the
+backend raises an error, the worker is killed and restarted and the
+scenario retried, up to `retries` times.  After that the scenario is
+quarantined: its errors are reported and the sweep moves on.
+
+Killing the worker doesn't end the solver, which HEC-RAS runs as a
+separate Ras.exe (COM server) process.  On restarts, the Ras.exe processes
+the worker started (and their child processes) are killed too, and then
+`kill` is called, if given, for any other cleanup.
+
+Geometry is still written in the main process; only open/compute/extract
+run in the worker.
+
+A backend is a picklable object with start() (called once in each new
+worker; returns the process IDs of solver processes it started, if any)
+and evaluate(scenario) => [formatted rows].  RasBackend is the real one;
+testing.FakeBackend hangs, crashes, or fails on command.
+"""
+
+import csv
+import multiprocessing
+import os
+import signal
+import subprocess
+from RaspyGeo.iterate import connect, scenario_data, write_scenario
+from RaspyGeo.write_geo import BlockCache
+
+
+class ScenarioFailed(Exception):
+    # A scenario that failed on every attempt; args[0] is [error]
+    pass
+
+
+def ras_pids():
+    # Process IDs of running Ras.exe processes (HEC-RAS runs on Windows
+    # only; there are none elsewhere)
+    if os.name != "nt":
+        return set()
+    out = subprocess.run(["tasklist", "/FI", "IMAGENAME eq Ras.exe",
+                          "/FO", "CSV", "/NH"],
+                         capture_output=True, text=True).stdout
+    return {int(row[1]) for row in csv.reader(out.splitlines())
+            if len(row) > 1 and row[1].isdigit()}
+
+
+def kill_pids(pids):
+    # Kill processes, with their child processes on Windows
+    for pid in pids:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)],
+                           capture_output=True)
+        else:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class RasBackend(object):
+    # HEC-RAS through Raspy
+    def __init__(self, projPath, locations, nprof, which="507"):
+        self.projPath = projPath
+        self.locations = locations
+        self.nprof = nprof
+        self.which = which
+        self.ras = None
+
+    def start(self):
+        # Returns the Ras.exe processes started by connecting
+        before = ras_pids()
+        self.ras = connect(self.projPath, self.which)
+        return sorted(ras_pids() - before)
+
+    def evaluate(self, scen):
+        self.ras.ops.openProject(self.projPath)
+        self.ras.ops.compute()
+        return scenario_data(self.ras, self.nprof, self.locations, scen)
+
+
+def serve(conn, backend):
+    # Worker process: report solver processes, then evaluate scenarios
+    # until told to stop (None)
+    conn.send(("started", backend.start() or []))
+    while True:
+        scen = conn.recv()
+        if scen is None:
+            break
+        try:
+            conn.send(("ok", backend.evaluate(scen)))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+class Supervisor(object):
+    def __init__(self, backend, timeout, retries=1, kill=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self.kill = kill
+        self.proc = None
+        self.conn = None
+        self.pids = None  # Solver processes of the current worker
+        self.restarts = 0
+
+    def __repr__(self):
+        return "Supervisor: %gs timeout, %d retries, %d restarts" % (
+            self.timeout, self.retries, self.restarts)
+
+    def start(self):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=serve,
+                                            args=(child, self.backend),
+                                            daemon=True)
+        self.proc.start()
+        child.close()
+        self.pids = None
+
+    def started(self):
+        # Wait for the worker to start (up to timeout); records its solver
+        # processes.  Returns False if it didn't.
+        if self.pids is None:
+            if not self.conn.poll(self.timeout):
+                return False
+            self.pids = self.conn.recv()[1]
+        return True
+
+    def stop(self, kill=True):
+        # Kill the worker and, if kill, its solver processes (then calling
+        # self.kill, if given), without waiting for them
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.join(5)
+            if self.proc.is_alive():
+                self.proc.kill()
+                self.proc.join()
+            if self.pids is None and self.conn.poll():
+                self.pids = self.conn.recv()[1]
+            self.conn.close()
+            self.proc = None
+        if kill:
+            kill_pids(self.pids or [])
+            if self.kill is not None:
+                self.kill()
+        self.pids = None
+
+    def attempt(self, scen):
+        # One try => (rows, None) or (None, error)
+        if self.proc is None:
+            self.start()
+        try:
+            if not self.started():
+                return (None, "worker start timed out after %gs" %
+                        self.timeout)
+            self.conn.send(scen)
+            if not self.conn.poll(self.timeout):
+                return (None, "timed out after %gs" % self.timeout)
+            (status, result) = self.conn.recv()
+        except (EOFError, OSError):
+            self.proc.join(5)
+            return (None, "worker crashed (exit code %s)" %
+                    self.proc.exitcode)
+        return (result, None) if status == "ok" else (None, result)
+
+    def evaluate(self, scen):
+        # Scenario name => rows, or raises ScenarioFailed
+        errors = []
+        for _ in range(self.retries + 1):
+            (rows, error) = self.attempt(scen)
+            if error is None:
+                return rows
+            errors.append(error)
+            # The solver may be in a bad state after any failure
+            self.stop()
+            self.restarts += 1
+        raise ScenarioFailed(errors)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.conn.send(None)
+                self.proc.join(self.timeout)
+            except OSError:
+                pass
+        self.stop(kill=False)
+
+
+def supervised(sup, ingeo, outgeo, tolerance=None, skip_invalid=False,
+               cache_size=None, archive=None):
+    # Like iterate.evaluator, but computing through a Supervisor.
+    # Returns f(scenario, modfns) => (rows, report), where scenarios that
+    # failed every attempt have no rows and report {"errors": [error]}.
+    cache = BlockCache(cache_size)
+
+    def evaluate(scen, modfns):
+        (report, reaches) = write_scenario(ingeo, outgeo, modfns, tolerance,
+                                           skip_invalid, cache)
+        if report:
+            return ([], report)
+        try:
+            rows = sup.evaluate(scen)
+        except ScenarioFailed as e:
+            return ([], {"errors": e.args[0]})
+        if archive is not None:
+            archive.add(scen, reaches)
+        return (rows, {})
+    return evaluate
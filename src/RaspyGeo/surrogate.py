@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Surrogate models of scenario results, to screen scenarios without running
+HEC-RAS.
+
+Shear, velocity, and depth usually vary smoothly with scenario parameters,
+so after enough runs they can be predicted.  A Surrogate fits a polynomial
+regression (least squares with a small ridge penalty) in the scenario
+parameters, one model per location ID, profile, and quantity.  Profiles
+are numbered in the order `run` writes them for each scenario and location.
+
+Predictions come with a standard error (residual standard deviation
+inflated for distance from the training data), so candidates whose
+predictions are too uncertain, or which are outside the range of the
+training data, can be flagged for a real HEC-RAS run (needs_solve).
+
+Typical use, with params as {scenario: [parameter values]}:
+    model = fit(read_results("output.txt"), params)
+    model.predict([3, 1.5], "R1U", 0, "shear.mc")  # => (mean, std)
+    model.needs_solve(candidates)
+"""
+
+from itertools import combinations_with_replacement
+from math import isnan, sqrt
+from RaspyGeo.iterate import cols, row_dict
+
+
+QUANTITIES = cols.strip().split(",")[6:]
+
+
+def read_results(path):
+    # Scenario data file (as written by `run`) => [row dict]
+    with open(path, "r") as f:
+        return [row_dict(ln.strip()) for ln in f.readlines()[1:]
+                if ln.strip()]
+
+
+def terms(nparam, degree):
+    # Polynomial terms as tuples of parameter indices, e.g. (0, 0, 1) is
+    # x0^2 x1; () is the constant.
+    return [tm for dg in range(degree + 1)
+            for tm in combinations_with_replacement(range(nparam), dg)]
+
+
+def solve_inverse(mat):
+    # Inverse of a square matrix by Gauss-Jordan elimination with partial
+    # pivoting
+    n = len(mat)
+    aug = [list(row) + [float(i == j) for j in range(n)]
+           for (i, row) in enumerate(mat)]
+    for col in range(n):
+        piv = max(range(col, n), key=lambda r: abs(aug[r][col]))
+        (aug[col], aug[piv]) = (aug[piv], aug[col])
+        div = aug[col][col]
+        aug[col] = [v / div for v in aug[col]]
+        for r in range(n):
+            if r != col and aug[r][col] != 0:
+                fac = aug[r][col]
+                aug[r] = [v - fac * pv for (v, pv) in zip(aug[r], aug[col])]
+    return [row[n:] for row in aug]
+
+
+def dot(a, b):
+    return sum(x * y for (x, y) in zip(a, b))
+
+
+def matvec(mat, vec):
+    return [dot(row, vec) for row in mat]
+
+
+class Surrogate(object):
+    # Polynomial models per (ID, profile, quantity); see module description
+    def __init__(self, bounds, degree, models):
+        self.bounds = bounds  # [(lo, hi)] of training parameters
+        self.degree = degree
+        self.terms = terms(len(bounds), degree)
+        # {(ID, profile, quantity): (coefficients, inverse, variance)}
+        self.models = models
+
+    def __repr__(self):
+        return "Surrogate: degree %d in %d parameters, %d models" % (
+            self.degree, len(self.bounds), len(self.models))
+
+    def features(self, params):
+        # Parameters scaled to [-1, 1] over the training range, for
+        # conditioning, then expanded into polynomial terms
+        sc = [2 * (p - lo) / (hi - lo) - 1 if hi > lo else 0
+              for (p, (lo, hi)) in zip(params, self.bounds)]
+        feats = []
+        for tm in self.terms:
+            v = 1.0
+            for ix in tm:
+                v *= sc[ix]
+            feats.append(v)
+        return feats
+
+    def predict(self, params, ident, profile, quantity):
+        # => (mean, standard error)
+        return self.predict_features(self.features(params),
+                                     (ident, profile, quantity))
+
+    def predict_features(self, feats, key):
+        (coef, inv, var) = self.models[key]
+        return (dot(coef, feats),
+                sqrt(var * (1 + dot(feats, matvec(inv, feats)))))
+
+    def predict_all(self, params):
+        # => {(ID, profile, quantity): (mean, standard error)}
+        feats = self.features(params)
+        return {key: self.predict_features(feats, key)
+                for key in self.models}
+
+    def extrapolating(self, params):
+        return any(p < lo or p > hi
+                   for (p, (lo, hi)) in zip(params, self.bounds))
+
+    def needs_solve(self, candidates, rel=0.05, floor=0.01):
+        # Candidates [params] that should be run in HEC-RAS: those outside
+        # the training range, or with any standard error above
+        # rel * |prediction| (at least `floor`, so near-zero predictions
+        # don't always count as uncertain).
+        return [params for params in candidates
+                if self.extrapolating(params) or
+                any(se > rel * max(abs(mean), floor)
+                    for (mean, se) in self.predict_all(params).values())]
+
+
+def fit(rows, params, degree=2, ridge=1e-6, quantities=QUANTITIES):
+    # rows: [row dict] (see read_results)
+    # params: {scenario: [parameter values]}; scenarios without parameters
+    # are ignored
+    # => Surrogate
+    rows = [row for row in rows if row["Scenario"] in params]
+    pts = list(params.values())
+    bounds = [(min(col), max(col)) for col in zip(*pts)]
+    model = Surrogate(bounds, degree, {})
+    feats = {scen: model.features(params[scen]) for scen in params}
+    # Group values by model: {(ID, profile, quantity): [(scenario, value)]}
+    data = {}
+    profiles = {}
+    for row in rows:
+        loc = (row["Scenario"], row["ID"])
+        profiles[loc] = profiles.get(loc, -1) + 1
+        for q in quantities:
+            if not isnan(row[q]):
+                data.setdefault((row["ID"], profiles[loc], q), []).append(
+                    (row["Scenario"], row[q]))
+    # Models fitted on the same scenarios share the same normal matrix
+    inverses = {}
+    for (key, obs) in data.items():
+        scens = tuple(sc for (sc, _) in obs)
+        if scens not in inverses:
+            xs = [feats[sc] for sc in scens]
+            normal = [[dot(ci, cj) + (ridge if i == j else 0)
+                       for (j, cj) in enumerate(zip(*xs))]
+                      for (i, ci) in enumerate(zip(*xs))]
+            inverses[scens] = solve_inverse(normal)
+        inv = inverses[scens]
+        xs = [feats[sc] for sc in scens]
+        ys = [v for (_, v) in obs]
+        coef = matvec(inv, [dot(col, ys) for col in zip(*xs)])
+        resid = [y - dot(coef, x) for (x, y) in zip(xs, ys)]
+        dof = len(ys) - len(coef)
+        var = dot(resid, resid) / dof if dof > 0 else float("inf")
+        model.models[key] = (coef, inv, var)
+    return model
@@ -9,9 +9,21 @@ Created on Fri Mar 24 09:38:05 2023
 Display utilities and testing.
 """
 
-from RaspyGeo.parse_geo import parse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from RaspyGeo import distribute
+from RaspyGeo.parse_geo import parse, read_fixed, first_line, get_rs
+from RaspyGeo.validate import validate
+from RaspyGeo.hecgeo import Geometry, Reach
+from RaspyGeo.spatial import CutLineIndex
+from RaspyGeo.archive import GeometryArchive
+from RaspyGeo.iterate import write_scenario
 from RaspyGeo.geofun import set_afp, set_lfc
-from RaspyGeo.write_geo import read_modify
+from RaspyGeo.write_geo import read_modify, read_write, coordinates, mann, \
+    stream_modify, BlockCache
 from RaspyGeo.display import *
 
 
@@ -94,3 +106,376 @@ mods = {'RiverOne        ,Upper           ': r1u,
 
 def testit():
     read_modify(geobase, mods, geopath)
+
+
+def test_fixed():
+    # Full-width values merge with their neighbours but must still decode
+    block = coordinates([(12345.67, 12345.67), (-1234.56, 99999.99),
+                         (123456.78, 1)])
+    vals = read_fixed(block.split("\n", 1)[1])
+    assert vals == [12345.67, 12345.67, -1234.56, 99999.99, 123456.8, 1], vals
+    block = mann([(12345.67, 0.035), (99999.99, 0.1)])
+    vals = read_fixed(block.split("\n", 1)[1])
+    assert vals == [12345.67, 0.035, 0, 99999.99, 0.1, 0], vals
+
+
+def test_roundtrip(path=geobase, out=geopath):
+    # Parse, write unmodified, and re-parse; geometry must be unchanged
+    # to within writing precision.
+    old = parse(path)
+    read_write(path, old, out)
+    new = parse(out)
+    for rch in old:
+        for rs in old[rch].geometries:
+            og = old[rch].geometries[rs].restore()
+            ng = new[rch].geometries[rs].restore()
+            for key in ["coordinates", "roughness"]:
+                assert len(og[key]) == len(ng[key]), (rch, rs, key)
+                assert all(abs(a - b) < 0.01
+                           for (p, q) in zip(og[key], ng[key])
+                           for (a, b) in zip(p, q)), (rch, rs, key)
+            assert og["banks"] == ng["banks"], (rch, rs)
+
+
+def test_stream(path=geobase, out=geopath):
+    # Streaming rewrite must match read_modify byte for byte, with
+    # scenario functions applied reach by reach.  Keys are reach names as
+    # from parse.
+    scen = {"RiverOne,Lower": lambda r: r.adjust_geometry(
+                set_afp(10, 3, 4, lambda x: x/2, 2, 0.1, 0.017, 0.15, 0.1,
+                        0.035)),
+            "RiverOne,Upper": r1u}
+    read_write(path, parse(path), out)
+    with open(out) as f:
+        unmodified = f.read()
+    for tolerance in [None, 0.1]:
+        reduction = read_modify(path, scen, out, tolerance)
+        with open(out) as f:
+            expected = f.read()
+        assert expected != unmodified
+        assert stream_modify(path, scen, out, tolerance) == reduction
+        with open(out) as f:
+            assert f.read() == expected, tolerance
+
+
+# Small geometry with ineffective areas, levees and a bridge, for writer
+# tests
+SAMPLE = """Geom Title=Sample
+
+River Reach=Sample          ,Main            
+Reach XY= 2 
+       0       0       1       1
+Rch Text X Y=1,1
+
+Type RM Length L Ch R = 1 ,400     ,100,100,100
+#Sta/Elev= 6 
+    1000     105    1020     101    1040     100    1060      99    1080     101
+    1100     105
+#Mann= 3 ,-1 , 0 
+    1000    .050       0    1040    .035       0    1060    .050       0
+Bank Sta=1040,1060
+XS Rating Curve= 0 ,0
+XS HTab Starting El and Incr=100,1, 20 
+#XS Ineff= 2 , 0 
+    1000    1020     103    1080    1100     103
+Permanent Ineff=
+       F       F
+Levee=-1,1020,105,,,,
+Exp/Cntr=0.3,0.1
+
+Type RM Length L Ch R = 1 ,300     ,50,50,50
+#Sta/Elev= 6 
+    5000     104    5030     100    5050      99    5070      98    5090     100
+    5110     104
+#Mann= 3 ,-1 , 0 
+    5000    .050       0    5050    .035       0    5070    .050       0
+Bank Sta=5050,5070
+XS Rating Curve= 0 ,0
+Exp/Cntr=0.3,0.1
+
+Type RM Length L Ch R = 3 ,250     ,50,50,50
+BEGIN DESCRIPTION:
+bridge
+END DESCRIPTION:
+Deck Dist Width WeirC Skew NumUp NumDn MinLoCord MaxHiCord MaxSubmerge Is_Ogee
+
+Type RM Length L Ch R = 1 ,200     ,100,100,100
+#Sta/Elev= 6 
+    5000     103    5030      99    5050      98    5070      97    5090      99
+    5110     103
+#Mann= 3 ,-1 , 0 
+    5000    .050       0    5050    .035       0    5070    .050       0
+Bank Sta=5050,5070
+XS Rating Curve= 0 ,0
+Exp/Cntr=0.3,0.1
+
+Type RM Length L Ch R = 1 ,100     ,0,0,0
+#Sta/Elev= 6 
+    5000     102    5030      98    5050      97    5070      96    5090      98
+    5110     102
+#Mann= 3 ,-1 , 0 
+    5000    .050       0    5050    .035       0    5070    .050       0
+Bank Sta=5050,5070
+XS Rating Curve= 0 ,0
+Exp/Cntr=0.3,0.1
+
+"""
+
+
+def parse_blocks(path):
+    # XS and structure blocks of a geometry file, in order
+    with open(path) as f:
+        return f.read().split("Type RM Length L Ch R = ")[1:]
+
+
+def test_stream_cm(path="sample.g01", out="out.g01"):
+    # Reaches repeated after "CM Alternative" are edited as read_modify
+    # does, so streaming still matches it.
+    reach = SAMPLE[SAMPLE.index("River Reach="):]
+    with tempfile.TemporaryDirectory() as tmp:
+        (path, out) = (os.path.join(tmp, path), os.path.join(tmp, out))
+        with open(path, "w") as f:
+            f.write(SAMPLE + "CM Alternative=Widen\n" + reach)
+        scen = {"Sample,Main": lambda r: r.adjust_geometry(
+            set_lfc(10, 1, 4, 0.035, 0.1))}
+        read_modify(path, scen, out)
+        with open(out) as f:
+            expected = f.read()
+        assert expected.split("CM Alternative")[1] != "=Widen\n" + reach
+        stream_modify(path, scen, out)
+        with open(out) as f:
+            assert f.read() == expected
+
+
+def test_insert(spacing=25):
+    # Interpolated sections written into a geometry: new blocks carry no
+    # station-dependent settings from their template and re-parse as
+    # valid sections.
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sample.g01")
+        with open(path, "w") as f:
+            f.write(SAMPLE)
+        out = os.path.join(tmp, "out.g01")
+        read_modify(path, {"Sample,Main": lambda r: r.set_interpolated(
+            spacing, 300)}, out)
+        blocks = parse_blocks(out)
+        new = [b for b in blocks if get_rs(b).endswith("*")]
+        assert [get_rs(b) for b in new] == ["375*", "350*", "325*"], \
+            [get_rs(b) for b in new]
+        for block in new:
+            tail = block[block.find("Bank Sta="):].splitlines()[1:]
+            assert [ln for ln in tail if ln] == \
+                ["XS Rating Curve= 0 ,0", "Exp/Cntr=0.3,0.1"], tail
+        # Reach lengths from 400 are split over the new sections
+        assert [first_line(b).split(",")[2] for b in blocks[:5]] == \
+            ["25", "25", "25", "25", "50"]
+        assert validate(parse(out)) == {}
+        # Not across the bridge at 250
+        read_modify(path, {"Sample,Main": lambda r: r.set_interpolated(
+            spacing)}, out)
+        rss = [get_rs(b) for b in parse_blocks(out)]
+        assert rss == ["400", "375*", "350*", "325*", "300", "250", "200",
+                       "175*", "150*", "125*", "100"], rss
+        assert [first_line(b).split(",")[2]
+                for b in parse_blocks(out)[4:6]] == ["50", "50"]
+        # Stretched sections: points shared by both parents differ only by
+        # float noise, and must not be written as duplicates
+        read_modify(path, {"Sample,Main": lambda r: r.adjust_geometry(
+            lambda co, ro, bk: ([(x * 1.37, y) for (x, y) in co],
+                                [(x * 1.37, n) for (x, n) in ro],
+                                (bk[0] * 1.37, bk[1] * 1.37))
+            ).set_interpolated(33, 300)}, out)
+        assert validate(parse(out)) == {}
+
+
+def test_cache():
+    # Each write scans every section in file order; a default cache must
+    # still hit for unchanged sections, with either writer.
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sample.g01")
+        with open(path, "w") as f:
+            f.write(SAMPLE)
+        out = os.path.join(tmp, "out.g01")
+        for write in [lambda c: read_write(path, parse(path), out, c),
+                      lambda c: stream_modify(path, {}, out, cache=c)]:
+            cache = BlockCache()
+            for _ in range(3):
+                write(cache)
+            assert (cache.hits, cache.misses) == (8, 4), cache
+
+
+def test_archive():
+    # Scenarios are archived from the reaches written, and an existing
+    # archive refuses a different baseline.
+    with tempfile.TemporaryDirectory() as tmp:
+        (path, other, out, back, store) = [
+            os.path.join(tmp, nm) for nm in
+            ["sample.g01", "other.g01", "out.g01", "back.g01", "arch.zip"]]
+        with open(path, "w") as f:
+            f.write(SAMPLE)
+        with open(other, "w") as f:
+            f.write(SAMPLE.replace("Sample", "Other"))
+        scen = {"Sample,Main": lambda r: r.adjust_geometry(
+            set_lfc(10, 1, 4, 0.035, 0.1))}
+        (report, reaches) = write_scenario(path, out, scen)
+        assert report == {}
+        with GeometryArchive(store, path) as arch:
+            arch.add("wide", reaches)
+        with GeometryArchive(store, path) as arch:
+            arch.rebuild("wide", back)
+        with open(out, "r") as f, open(back, "r") as g:
+            assert f.read() == g.read()
+        try:
+            GeometryArchive(store, other)
+            assert False, "different baseline accepted"
+        except ValueError:
+            pass
+
+
+def test_spatial(timeout=1):
+    # Cut lines all on one horizontal line (zero-height extent), and query
+    # boxes far larger than the data, must stay fast.
+    def xs(cutline):
+        return Geometry([(0, 1), (10, 0), (20, 1)], [(0, 0.035)], (0, 20),
+                        cutline)
+    t = time.perf_counter()
+    one = CutLineIndex({"R,A": Reach("R,A", {"100": xs([(0, 5),
+                                                        (100, 5)])})})
+    assert one.near((50, 5), 1) == {"R,A": [100.0]}
+    index = CutLineIndex({"R,A": Reach("R,A", {
+        "100": xs([(0, 5), (100, 5)]), "200": xs([(200, 5), (300, 5)])})})
+    assert index.near((50, 5), 100) == {"R,A": [100.0]}
+    assert index.near((50, 5), 1e7) == {"R,A": [100.0, 200.0]}
+    assert index.within([(-1e7, -1e7), (1e7, -1e7), (1e7, 1e7),
+                         (-1e7, 1e7)]) == {"R,A": [100.0, 200.0]}
+    assert index.near((1e6, 1e6), 10) == {}
+    assert time.perf_counter() - t < timeout, index
+
+
+def bench_import(stmt="import RaspyGeo; RaspyGeo.parse", n=5):
+    # Import time benchmark: median seconds to run `stmt` in a fresh
+    # interpreter, as a worker process or CLI tool would.
+    code = "import time; t = time.perf_counter(); %s; " \
+        "print(time.perf_counter() - t)" % stmt
+    times = sorted(float(subprocess.run([sys.executable, "-c", code],
+                                        capture_output=True, check=True,
+                                        text=True).stdout)
+                   for _ in range(n))
+    return times[n // 2]
+
+
+class FakeBackend(object):
+    # Stand-in for supervise.RasBackend.  behaviour: {scenario: action},
+    # where action is "hang", "crash", "error", or "flaky" (error on the
+    # first attempt only; needs `marker`, a file path, to remember).
+    # Other scenarios return one row.
+    # If solver, each worker starts a stand-in solver process, which
+    # restarts must kill.
+    def __init__(self, behaviour, marker=None, solver=False):
+        self.behaviour = behaviour
+        self.marker = marker
+        self.solver = solver
+
+    def start(self):
+        if self.solver:
+            return [subprocess.Popen([sys.executable, "-c",
+                                      "import time; time.sleep(3600)"]).pid]
+
+    def evaluate(self, scen):
+        action = self.behaviour.get(scen)
+        if action == "hang":
+            time.sleep(3600)
+        elif action == "crash":
+            os._exit(1)
+        elif action == "error":
+            raise RuntimeError("compute failed")
+        elif action == "flaky" and not os.path.exists(self.marker):
+            open(self.marker, "w").close()
+            raise RuntimeError("compute failed once")
+        return ["%s,ID,River,Reach,100,1,1,1,1,1,1,1,1,1,1" % scen]
+
+
+def alive(pid):
+    # Process exists (and isn't a zombie)
+    if os.name == "nt":
+        return str(pid) in subprocess.run(
+            ["tasklist", "/FI", "PID eq %d" % pid, "/FO", "CSV", "/NH"],
+            capture_output=True, text=True).stdout
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+def test_supervisor(marker="flaky.marker"):
+    from RaspyGeo.supervise import Supervisor, ScenarioFailed, kill_pids
+    if os.path.exists(marker):
+        os.remove(marker)
+    sup = Supervisor(FakeBackend({"hang": "hang", "crash": "crash",
+                                  "error": "error", "flaky": "flaky"},
+                                 marker, solver=True), timeout=2, retries=1)
+    for scen in ["ok", "flaky", "ok2"]:
+        assert sup.evaluate(scen)[0].startswith(scen + ","), scen
+    solver = sup.pids[0]
+    assert alive(solver)
+    for scen in ["hang", "crash", "error"]:
+        try:
+            sup.evaluate(scen)
+            assert False, scen
+        except ScenarioFailed as e:
+            assert len(e.args[0]) == 2, e.args
+    # Restarts killed the solver along with the worker
+    time.sleep(0.5)
+    assert not alive(solver)
+    assert sup.evaluate("ok3")[0].startswith("ok3,")
+    solver = sup.pids[0]
+    sup.close()
+    kill_pids([solver])
+    os.remove(marker)
+    return sup
+
+
+def test_queue(lease=0.5):
+    # Local stand-in for a shared queue directory: claim, lease expiry,
+    # stale retries, retry limits, and lease renewal during long runs.
+    with tempfile.TemporaryDirectory() as queue:
+        distribute.submit(queue, {"A": [1], "B": [2]}, retries=1,
+                          lease=lease)
+        stale = distribute.claim(queue)
+        assert stale["scenario"] == "A"
+        # Not yet expired
+        distribute.reclaim(queue)
+        assert distribute.job_ids(queue, "jobs") == ["000001"]
+        time.sleep(lease * 1.5)
+        distribute.reclaim(queue)
+        assert distribute.job_ids(queue, "jobs") == ["000000", "000001"]
+        job = distribute.claim(queue)
+        assert (job["scenario"], job["attempts"]) == ("A", 1)
+        # The first worker lost its lease: its retry must not touch the
+        # new claim
+        distribute.retry(queue, stale, "stale")
+        assert [c[0] for c in distribute.claims(queue)] == ["000000"]
+        assert distribute.job_ids(queue, "jobs") == ["000001"]
+        # Out of retries
+        distribute.retry(queue, job, "solver failed")
+        assert distribute.job_ids(queue, "failed") == ["000000"]
+        assert distribute.claims(queue) == []
+
+        def evaluate(scen, modfns):
+            # Outlast the lease; the heartbeat must keep it
+            time.sleep(lease * 2)
+            distribute.reclaim(queue)
+            assert distribute.job_ids(queue, "jobs") == []
+            return (["%s,%s" % (scen, modfns)], {})
+        assert distribute.work(queue, lambda x: x, evaluate) == 1
+        failed = distribute.collect(queue, os.path.join(queue, "out.csv"),
+                                    poll=0.1)
+        assert list(failed) == ["A"], failed
+        assert failed["A"]["errors"] == ["lease expired", "solver failed"]
+        with open(os.path.join(queue, "out.csv")) as f:
+            assert f.read().endswith("B,2\n")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Check modified geometry for problems HEC-RAS will reject or mishandle.
+
+Geometry functions (including set_afp, see the known bugs noted there) can
+produce sections that HEC-RAS fails on, or worse, computes garbage from.
+Checking right after the scenario function catches these before any
+solver time is spent.
+
+Reports are {reach name: {rs: [problem]}}, listing only cross-sections
+with problems, so an empty report means the geometry is valid.
+"""
+
+from math import isfinite
+
+
+# HEC-RAS limit on points per cross-section
+MAX_POINTS = 500
+
+
+def check_geometry(geo):
+    # Geometry => [problem description]
+    co = geo.coordinates
+    ro = geo.roughness
+    problems = []
+    if len(co) < 2:
+        return ["fewer than 2 points"]
+    if len(co) > MAX_POINTS:
+        problems.append("%d points (maximum %d)" % (len(co), MAX_POINTS))
+    if not all(isfinite(v) for pt in co + ro for v in pt) or \
+            not all(isfinite(v) for v in geo.banks):
+        problems.append("non-finite values")
+    back = [ix for ix in range(1, len(co)) if co[ix][0] < co[ix-1][0]]
+    if back:
+        problems.append("stations decrease at points %s" % back)
+    dups = [ix for ix in range(1, len(co)) if co[ix] == co[ix-1]]
+    if dups:
+        problems.append("duplicate points at %s" % dups)
+    (left, right) = (co[0][0], co[-1][0])
+    if not ro:
+        problems.append("no roughness")
+    else:
+        outside = [mn[0] for mn in ro if mn[0] < left or mn[0] > right]
+        if outside:
+            problems.append("roughness breakpoints outside section: %s" %
+                            outside)
+        if any(ro[ix][0] < ro[ix-1][0] for ix in range(1, len(ro))):
+            problems.append("roughness breakpoints out of order")
+        if ro[0][0] > left:
+            problems.append("no roughness at left edge")
+        if any(mn[1] <= 0 for mn in ro):
+            problems.append("non-positive roughness")
+    if geo.banks[0] > geo.banks[1]:
+        problems.append("left bank right of right bank")
+    if any(bk < left or bk > right for bk in geo.banks):
+        problems.append("bank stations outside section: %s" %
+                        (geo.banks,))
+    return problems
+
+
+def check_reach(reach):
+    # Reach => {rs: [problem]} for cross-sections with problems
+    report = {rs: check_geometry(reach.geometries[rs])
+              for rs in reach.geometries}
+    return {rs: report[rs] for rs in report if report[rs]}
+
+
+def validate(reaches, names=None):
+    # {name: Reach} => {name: {rs: [problem]}} for reaches with problems.
+    # If names is given (e.g. the keys of a scenario's modfns), only those
+    # reaches are checked (names not in reaches are ignored, as by
+    # write_geo.modify).
+    names = reaches if names is None else [nm for nm in names
+                                           if nm in reaches]
+    report = {nm: check_reach(reaches[nm]) for nm in names}
+    return {nm: report[nm] for nm in report if report[nm]}
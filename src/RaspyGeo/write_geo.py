@@ -75,15 +75,29 @@ and no more than two (three for Manning's).
 """
 
 
-from RaspyGeo.parse_geo import first_line, rest_lines, get_rs, parse, mk_name
+import os
+from collections import OrderedDict
+from RaspyGeo.parse_geo import first_line, rest_lines, get_rs, parse, \
+    mk_name, sep_inner
+from RaspyGeo.hecgeo import rs2float, fmt_rs
+
+
+def fmt_fixed(x, decimals):
+    # Format into an 8-character fixed-width field, dropping decimals as
+    # needed so large values never spill into the next column.
+    for dec in range(decimals, -1, -1):
+        txt = "%8.*f" % (dec, x)
+        if len(txt) <= 8:
+            return txt
+    return txt
 
 
 def fmt_num(x):
-    return "% 8.2f" % x
+    return fmt_fixed(x, 2)
 
 
 def fmt_mann(x):
-    return "% 8.3f" % x
+    return fmt_fixed(x, 3)
 
 
 def fmt_nsta(x):
@@ -136,11 +150,61 @@ def banksta(banks):
     return 'Bank Sta=%.2f,%.2f' % banks
 
 
+class BlockCache(object):
+    # Bounded LRU cache of rendered cross-section text (#Sta/Elev through
+    # Bank Sta).  In scenario sweeps, many scenarios produce identical
+    # geometry for some cross-sections, which then only need formatting
+    # once.  Keys are (reach, rs, Geometry.content_key()).
+    # Each write visits every cross-section in file order, so an LRU
+    # smaller than the model never hits.  By default (maxsize None), the
+    # cache is sized to twice the number of cross-sections written (see
+    # fit), keeping the whole model plus changed sections.
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.auto = maxsize is None
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "BlockCache: %d/%s blocks, %d hits, %d misses" % (
+            len(self.blocks), self.maxsize, self.hits, self.misses)
+
+    def fit(self, count):
+        # Size an automatically sized cache for `count` cross-sections
+        if self.auto:
+            self.maxsize = max(self.maxsize or 0, 2 * count)
+
+    def get(self, key, newgeo):
+        if key in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+        else:
+            self.misses += 1
+            self.blocks[key] = render(newgeo)
+            if self.maxsize is not None and len(self.blocks) > self.maxsize:
+                self.blocks.popitem(last=False)
+        return self.blocks[key]
+
+
+def render(newgeo):
+    # Geometry => (#Sta/Elev block, #Mann block, Bank Sta line)
+    geos = newgeo.restore()
+    return (coordinates(geos["coordinates"]),
+            mann(geos["roughness"]),
+            banksta(geos["banks"]))
+
+
 def edit_block(original,
-               newgeo):
+               newgeo,
+               cache=None,
+               key=None):
     # Takes a Geometry object as an input in addition to the original
     # text block.
-    geos = newgeo.restore()
+    # If a BlockCache is given, key identifies the cross-section (reach,
+    # rs) for caching.
+    rendered = render(newgeo) if cache is None else \
+        cache.get(key + (newgeo.content_key(),), newgeo)
     # Find Manning's block, since the next block is not fixed.
     # Each Manning's roughness occupies exactly 24 characters,
     # plus one for each time there are more than 3.
@@ -161,17 +225,99 @@ def edit_block(original,
     slices = [
         # #Sta/Elev is easy.
         original[:(original.find('#Sta/Elev')-1)],
-        coordinates(geos["coordinates"]),
-        mann(geos["roughness"]),
+        rendered[0],
+        rendered[1],
         # Middle bit (may be '', hence filtering)
         original[endman:bankix],
-        banksta(geos["banks"]),
+        rendered[2],
         original[endbank:]
         ]
     return "\n".join([slc for slc in slices if slc != ''])
 
 
-def proc_reach(name, text, reaches):
+def set_lengths(block, lengths):
+    # Replace the downstream reach lengths (L, Ch, R) in a block's first
+    # line, e.g. `1 ,43505   ,139,139,139`
+    fields = first_line(block).split(",")
+    return ",".join(fields[:2] + [fmt_rs(ln) for ln in lengths] +
+                    fields[5:]) + "\n" + rest_lines(block)
+
+
+# Lines after Bank Sta= that don't depend on stations or elevations, so
+# new blocks can copy them from a neighbouring XS
+KEEP = ("XS Rating Curve=", "Exp/Cntr=")
+
+
+def new_block(template, rs, newgeo, lengths):
+    # Block for a cross-section not in the original file (e.g. an
+    # interpolated section), based on a neighbouring XS block.
+    # Only settings in KEEP are copied from the template, not ineffective
+    # areas, levees, obstructions, HTab, descriptions, etc.
+    geos = newgeo.restore()
+    bankix = template.find('Bank Sta=')
+    tail = rest_lines(template[bankix:])
+    tail = "".join([ln for ln in tail.splitlines(True)
+                    if ln.startswith(KEEP)]) + "\n"
+    return "\n".join([
+        "1 ,%-8s,%s" % (rs, ",".join(fmt_rs(ln) for ln in lengths)),
+        coordinates(geos["coordinates"]),
+        mann(geos["roughness"]),
+        banksta(geos["banks"]),
+        tail])
+
+
+def insert_new(blocks, edited, rch):
+    # Insert blocks for cross-sections in rch that are not in the file
+    # (e.g. from Reach.set_interpolated), keeping the file in descending
+    # river station order.  The preceding block's reach lengths are split
+    # between it and the new sections in proportion to river station.
+    # New sections can only go between two cross-sections, not next to a
+    # structure (see Reach.set_interpolated).
+    # blocks: original blocks; edited: the same after editing.
+    file_rs = {get_rs(block) for block in blocks}
+    new = sorted([rs for rs in rch.geometries if rs not in file_rs],
+                  key=rs2float, reverse=True)
+    if not new:
+        return edited
+    out = []
+    template = None  # Nearest upstream XS block with geometry
+    for (block, ed) in zip(blocks, edited):
+        rs = rs2float(get_rs(block))
+        here = [nw for nw in new if rs2float(nw) > rs]
+        new = new[len(here):]
+        if here and out:
+            prev = out[-1]
+            if get_rs(prev) not in rch.geometries or \
+                    get_rs(block) not in rch.geometries:
+                raise ValueError(
+                    "%s: cannot insert %s between %s and %s (not a "
+                    "cross-section)" % (rch.name.strip(), ", ".join(here),
+                                        get_rs(prev), get_rs(block)))
+            try:
+                lengths = [float(ln)
+                           for ln in first_line(prev).split(",")[2:5]]
+            except ValueError:
+                # No lengths to split (shouldn't happen mid-reach)
+                lengths = [0, 0, 0]
+            pts = [rs2float(get_rs(prev))] + [rs2float(nw) for nw in here] +\
+                [rs]
+            span = pts[0] - pts[-1]
+            # Rounded as written, with the remainder in the last piece so
+            # the pieces still add up
+            pieces = [[round(ln * (pts[k] - pts[k+1]) / span, 2)
+                       for ln in lengths] for k in range(len(pts) - 2)]
+            pieces.append([ln - sum(pc[ix] for pc in pieces)
+                           for (ix, ln) in enumerate(lengths)])
+            out[-1] = set_lengths(prev, pieces[0])
+            out += [new_block(template, nw, rch.geometries[nw], pc)
+                    for (nw, pc) in zip(here, pieces[1:])]
+        out.append(ed)
+        if get_rs(block) in rch.geometries:
+            template = block
+    return out
+
+
+def proc_reach(name, text, reaches, cache=None):
     # The processor function gets a name, which is the reach name
     # (first line), and the remaining reach text.
     # It should then be possible to loop through XS blocks,
@@ -179,39 +325,130 @@ def proc_reach(name, text, reaches):
     # Reaches (e.g. returned by parse) have the `name` values as their
     # keys, so that makes it easy.  Cross-sections have get_rs(block), for
     # each block, as their key within Reach.geometries, also conveniently.
+    # Cross-sections in the Reach but not the file (interpolated sections)
+    # are inserted.
     rch = reaches[mk_name(name)]
     sep = "Type RM Length L Ch R = "
     chunks = text.split(sep)
     header = chunks[0]
-    return name + "\n" + sep.join([header] + [
-        edit_block(block, rch.geometries[get_rs(block)])
+    blocks = chunks[1:]
+    edited = [
+        edit_block(block, rch.geometries[get_rs(block)], cache,
+                   (rch.name, get_rs(block)))
         # If it is not in the geometry (e.g. a bridge), just return the
         # old one.
         if get_rs(block) in rch.geometries else block
-        for block in chunks[1:]
-        ])
+        for block in blocks
+        ]
+    return name + "\n" + sep.join([header] +
+                                   insert_new(blocks, edited, rch))
 
 
-def read_write(file, reaches, out=None):
+def read_write(file, reaches, out=None, cache=None):
     # Read the file path, then separate it into
     # {reach: fn(name, text)}
+    # cache: optional BlockCache, reused across scenarios
     out = out if out is not None else file
     with open(file, "r") as f:
         raw = f.read()
     with open(file + ".bak", "w") as f:
         f.write(raw)
+    if cache is not None:
+        cache.fit(sum(len(reaches[rch].geometries) for rch in reaches))
     chunks = raw.split("River Reach=")
     data = "River Reach=".join([chunks[0]] + [
-        proc_reach(first_line(x), rest_lines(x), reaches)
+        proc_reach(first_line(x), rest_lines(x), reaches, cache)
         for x in chunks[1:]])
     with open(out, "w") as f:
         f.write(data)
 
 
-def read_modify(file, modfns, out=None):
+def modify(file, modfns, tolerance=None):
     # modfns => {reach name: f(Reach)} where f modifies the Reach as desired.
+    # Returns all reaches in the file, with modifications applied.
+    # If tolerance is given, modified reaches are simplified (see
+    # Reach.set_simplify).
     reaches = parse(file)
     newrch = {rch: modfns[rch](reaches[rch])
               if rch in modfns else reaches[rch]
               for rch in reaches}
+    if tolerance is not None:
+        # Keys not in the file are ignored, as above
+        for rch in modfns:
+            if rch in newrch:
+                newrch[rch].set_simplify(tolerance)
+    return newrch
+
+
+def read_modify(file, modfns, out=None, tolerance=None):
+    # Modify (see modify) and write.  Returns the point reduction as
+    # {reach name: {rs: (before, after)}}, empty if not simplifying.
+    newrch = modify(file, modfns, tolerance)
     read_write(file, newrch, out)
+    return {rch: newrch[rch].reduction for rch in modfns if rch in newrch} \
+        if tolerance is not None else {}
+
+
+def reach_chunks(lines):
+    # Lines of a geometry file => the same text as raw.split("River Reach="),
+    # one chunk at a time
+    marker = "River Reach="
+    chunk = []
+    for line in lines:
+        if line.startswith(marker):
+            yield "".join(chunk)
+            chunk = [line[len(marker):]]
+        else:
+            chunk.append(line)
+    yield "".join(chunk)
+
+
+def stream_modify(file, modfns, out=None, tolerance=None, cache=None):
+    # Like read_modify, for geometry files too large to hold in memory
+    # several times over: the file is read, modified, and written one reach
+    # at a time, so only one reach (plus the modified ones) is in memory.
+    # The output (and .bak) is the same as read_modify's.
+    # Reaches after "CM Alternative" (channel modification alternatives,
+    # which parse ignores) are edited like read_write does, with the
+    # modified reach of the same name; other reaches there are unchanged
+    # either way, so they are copied.
+    out = out if out is not None else file
+    tmp = out + ".tmp"
+    reduction = {}
+    modified = {}  # Modified reaches, for their channel modifications
+    cutoff = False
+    count = 0  # Cross-sections so far, to size the cache
+    with open(file, "r") as f, open(file + ".bak", "w") as bak, \
+            open(tmp, "w") as g:
+
+        def backup(lines):
+            for line in lines:
+                bak.write(line)
+                yield line
+        for (ix, chunk) in enumerate(reach_chunks(backup(f))):
+            if ix == 0:
+                cutoff = "CM Alternative" in chunk
+                g.write(chunk)
+                continue
+            name = mk_name(first_line(chunk))
+            body = rest_lines(chunk)
+            if cutoff:
+                g.write("River Reach=" + (
+                    proc_reach(first_line(chunk), body, modified, cache)
+                    if name in modified else chunk))
+                continue
+            cutoff = "CM Alternative" in body
+            rch = sep_inner(name, body.split("CM Alternative")[0])
+            if name in modfns:
+                rch = modfns[name](rch)
+                if tolerance is not None:
+                    rch.set_simplify(tolerance)
+                    reduction[name] = rch.reduction
+                modified[name] = rch
+            if cache is not None:
+                count += len(rch.geometries)
+                cache.fit(count)
+            g.write("River Reach=" + proc_reach(first_line(chunk), body,
+                                                {name: rch}, cache))
+    os.replace(tmp, out)
+    return reduction